@@ -0,0 +1,135 @@
+import math
+import threading
+from contextlib import contextmanager
+
+# cheap control methods, never rejected and served even when all workers are busy
+PRIORITY = frozenset(("is_alive", "_metrics", "_cache_stats", "_compression_stats",
+                      "_job_status", "_job_cancel", "_job_stats", "_admission_stats",
+                      "_event_publish", "_event_unwatch", "_event_stats"))
+
+
+def retry_after_header(seconds: float) -> str:
+    """Retry-After header value, it is whole seconds"""
+    return str(max(1, math.ceil(seconds)))
+
+
+class Overloaded(Exception):
+    """Raised when call is rejected by admission control, answered with 503 and Retry-After"""
+
+    def __init__(self, method: str, reason: str, retry_after: float):
+        self.method = method
+        self.retry_after = retry_after
+        super().__init__(f"method '{method}' rejected: {reason}")
+
+
+SMALL_BODY = 64 * 1024  # bodies up to that size are not counted against body budget
+
+BODY = "<body>"  # method name under which body budget rejections are counted
+
+
+class _Reservation:
+    """Bytes of body budget held by one request"""
+
+    def __init__(self, admission, size: int):
+        self.admission = admission
+        self.size = size
+
+    def grow(self, size: int):
+        """Reserves size bytes more, raises Overloaded if budget is exhausted"""
+        self.admission._reserve_bytes(size)
+        self.size += size
+
+
+class Admission:
+    """Admission control of method calls
+
+    Args:
+        :limits: dict 'method : max calls running at once', calls above that are rejected
+        :priority: methods which are never rejected
+        :retry_after: seconds clients are asked to wait before retrying a rejected call
+        :max_body_bytes: bytes of request bodies held in memory at once by all requests,
+            requests above that are rejected; None means no limit
+        :max_held: requests allowed to hold a worker for long at once (event streams,
+            job long-polls), should be well below number of workers; 0 - none
+    """
+
+    def __init__(self, limits: dict = None, priority = PRIORITY, retry_after: float = 1.0,
+                 max_body_bytes: int = None, max_held: int = 0):
+        self.max_held = max_held
+        self.held = 0
+        self.priority = frozenset(priority)
+        self.retry_after = retry_after
+        self.max_body_bytes = max_body_bytes
+        self.body_bytes = 0  # reserved at the moment
+        self._slots = dict({method: threading.BoundedSemaphore(limit)
+                            for method, limit in (limits or {}).items()})
+        self._lock = threading.Lock()
+        self._rejected = {}  # method : count
+
+    def _reject(self, method: str, reason: str):
+        with self._lock:
+            self._rejected[method] = self._rejected.get(method, 0) + 1
+        raise Overloaded(method, reason, self.retry_after)
+
+    @contextmanager
+    def admit(self, method: str, priority_only: bool = False, wait: bool = False):
+        """Holds method slot while call runs, raises Overloaded if there is no free one
+
+        priority_only is set for requests served beyond worker limit,
+        only priority methods are admitted then.
+        With wait the slot is waited for instead, for callers bounded by other means (jobs)
+        """
+        if method in self.priority:
+            yield
+            return
+        if priority_only:
+            self._reject(method, "all workers are busy")
+        slots = self._slots.get(method)
+        if slots is not None and not slots.acquire(blocking = wait):
+            self._reject(method, "too many calls running")
+        try:
+            yield
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def _reserve_bytes(self, size: int):
+        with self._lock:
+            if self.max_body_bytes is None or self.body_bytes + size <= self.max_body_bytes:
+                self.body_bytes += size
+                return
+        self._reject(BODY, f"{size} body bytes over budget of {self.max_body_bytes}")
+
+    @contextmanager
+    def reserve(self, size: int):
+        """Holds size bytes of body budget while request is read and run,
+        raises Overloaded if budget is exhausted
+
+        Bodies up to SMALL_BODY bytes are not counted, so control calls always get through.
+        Yields reservation, which can grow once body size is known better
+        """
+        reservation = _Reservation(self, 0)
+        if size > SMALL_BODY:
+            reservation.grow(size)
+        try:
+            yield reservation
+        finally:
+            with self._lock:
+                self.body_bytes -= reservation.size
+
+    @contextmanager
+    def hold(self):
+        """Yields True if request may hold its worker for long, False if max_held are held already"""
+        with self._lock:
+            held = self.held < self.max_held
+            self.held += held
+        try:
+            yield held
+        finally:
+            with self._lock:
+                self.held -= held
+
+    def stats(self) -> dict:
+        """dict 'method : number of rejected calls', body budget rejections are under '<body>'"""
+        with self._lock:
+            return dict(self._rejected)
@@ -0,0 +1,157 @@
+import asyncio
+from uuid import uuid4
+from xmlrpc.client import dumps, loads, ProtocolError
+
+from . import codec
+from .resolver import RPCResolver
+from .client import RPCCallError, TIMEOUT
+
+
+class AsyncRPCClient(RPCResolver):
+
+    """
+    asyncio RPC Client
+
+    Method call returns coroutine, awaiting it returns result or raise RPCCallError
+
+    Keeps up to pool_size keep-alive connections,
+    the pool is reset when client gets used from another event loop
+
+    Calls are sent in binary format (see codec) if server supports it,
+    binary = False forces xml
+    """
+
+    def __init__(self, host, port, remote_host_name = None, timeout = TIMEOUT, pool_size = 4,
+                 binary = True):
+        self._host = host
+        self._port = port
+        self._remote_host_name = remote_host_name
+        self._timeout = timeout
+        self._pool_size = pool_size
+        self._loop = None
+        self._idle = []  # [(reader, writer)]
+        self._slots = None
+        self._binary = None if binary else False  # None until negotiated
+        self._methods = {}  # name : AsyncRPCMethodCall
+
+    def __getattribute__(self, name: str):  # skipping usual attr resolving
+        if name.startswith("_"):
+            return object.__getattribute__(self, name)
+        methods = object.__getattribute__(self, "_methods")
+        try:
+            return methods[name]
+        except KeyError:
+            method = methods[name] = AsyncRPCMethodCall(self, name)
+            return method
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:  # streams cannot be shared between loops
+            self._loop = loop
+            self._idle = []
+            self._slots = asyncio.Semaphore(self._pool_size)
+
+    async def _request(self, method, params):
+        if self._binary:
+            body = codec.dumps([method, params])
+            content_type = codec.CONTENT_TYPE
+        else:
+            body = dumps(params, method, encoding = "utf-8", allow_none = True).encode("utf-8")
+            content_type = "text/xml"
+        data, headers = await self._send(body, content_type)
+        if self._binary is None:
+            self._binary = codec.NAME in headers.get("x-rpc-codecs", "").split(",")
+        if headers.get("content-type") == codec.CONTENT_TYPE:
+            return codec.loads(data)
+        (ret,), _ = loads(data, use_datetime = True, use_builtin_types = True)
+        return ret
+
+    async def _send(self, body: bytes, content_type: str):
+        """Returns tuple (response body, response headers)"""
+        self._bind_loop()
+        async with self._slots:
+            for i in (0, 1):
+                reused = bool(self._idle)
+                if reused:
+                    reader, writer = self._idle.pop()
+                else:
+                    reader, writer = await asyncio.open_connection(self._host, self._port)
+                try:
+                    data, headers, keep_alive = await self._exchange(reader, writer, body,
+                                                                     content_type)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if i or not reused:
+                        raise
+                    continue  # server closed idle connection
+                except:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return data, headers
+
+    async def _exchange(self, reader, writer, body: bytes, content_type: str):
+        writer.write(b"POST / HTTP/1.1\r\n"
+                     b"Host: %s:%d\r\n"
+                     b"Content-Type: %s\r\n"
+                     b"Content-Length: %d\r\n\r\n" % (self._host.encode(), self._port,
+                                                        content_type.encode(), len(body)))
+        writer.write(body)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by server")
+        version, status, reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, value = line.decode("latin-1").split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        keep_alive = (version == "HTTP/1.1"
+                      and headers.get("connection", "").lower() != "close"
+                      and "content-length" in headers)
+        if "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+        if status != "200":
+            raise ProtocolError(f"{self._host}:{self._port}/", int(status), reason, headers)
+        return data, headers, keep_alive
+
+
+class AsyncRPCMethodCall:
+    """Used to control async rpc methods call
+
+    Resolved nested methods are cached like in RPCMethodCall
+    """
+
+    def __init__(self, client: AsyncRPCClient, name: str):
+        self.client = client
+        self.method = name
+        self.children = {}
+
+    def __getattr__(self, name: str):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        try:
+            return self.children[name]
+        except KeyError:
+            child = self.children[name] = AsyncRPCMethodCall(self.client, f"{self.method}.{name}")
+            return child
+
+    def __str__(self):
+        return f'{self.__class__.__name__}: method={self.method}'
+
+    async def __call__(self, *args, **kwargs):
+        id_ = uuid4().hex
+        ret = await asyncio.wait_for(self.client._request(self.method, (args, kwargs, id_)),
+                                     self.client._timeout)
+        tb = ret.get("traceback")
+        if tb:
+            raise RPCCallError(self.method, tb, id_, self.client._remote_host_name)
+        return ret.get("returns", None)
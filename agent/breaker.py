@@ -0,0 +1,94 @@
+import threading
+import time
+
+
+class HostUnavailableError(Exception):
+    """Raised instead of calling a host whose circuit breaker is open"""
+
+    def __init__(self, host_name, retry_in: float):
+        self.host_name = host_name
+        self.retry_in = retry_in
+        super().__init__()
+
+    def __str__(self):
+        return f"<{self.host_name}> is unavailable, next try in {self.retry_in:.1f}s"
+
+
+class CircuitBreaker:
+    """Circuit breaker and load tracker of a host
+
+    closed: calls go through, failure_threshold consecutive failures open it\n
+    open: calls fail right away, after reset_timeout one call is let through (half-open),
+    its success closes the breaker, failure opens it again
+
+    Also tracks latency (exponentially weighted average) and calls in flight,
+    score() combines both, the lower the better
+
+    Args:
+        :failure_threshold: consecutive failures opening the breaker
+        :reset_timeout: seconds the breaker stays open before a trial call
+        :latency_weight: weight of the latest latency in the average, 0..1
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 10.0,
+                 latency_weight: float = 0.3):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_weight = latency_weight
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.latency = None
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Tells if a call may go through, has to be followed by record() if it does"""
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        with self._lock:
+            if (self.state == CircuitBreaker.OPEN
+                    and time.monotonic() - self.opened_at >= self.reset_timeout):
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record(self, success: bool, latency: float = None):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.state = CircuitBreaker.CLOSED
+                if latency is not None:
+                    self.latency = latency if self.latency is None else (
+                        self.latency_weight * latency + (1 - self.latency_weight) * self.latency)
+                return
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+    def trip(self):
+        """Opens the breaker right away, e.g. for host found unreachable"""
+        with self._lock:
+            self.failures = max(self.failures, self.failure_threshold)
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.monotonic()
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def score(self) -> float:
+        """Expected wait of a new call, hosts without latency data score 0"""
+        return (self.latency or 0.0) * (self.in_flight + 1)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ResultCache:
+    """TTL + LRU cache of method results
+
+    Identical calls running at once are merged, the method runs once
+    and all callers get its result. Errors are not cached.
+    clear() drops results of calls running at the moment as well, they may be stale
+
+    Args:
+        :ttl: result is served from cache for that many seconds
+        :max_entries: least recently used results are dropped above that
+    """
+
+    def __init__(self, ttl: float = 60.0, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key : (expires, result)
+        self._in_flight = {}  # key : Future
+        self._generation = 0  # incremented by clear()
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+
+    @staticmethod
+    def key(args, kwargs):
+        return repr((args, sorted(kwargs.items())))
+
+    def call(self, key, foo):
+        """Returns tuple (result, hit), calls foo() on miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], True
+                del self._entries[key]
+            running = self._in_flight.get(key)
+            if running is not None:
+                self.merged += 1
+            else:
+                future = self._in_flight[key] = Future()
+                generation = self._generation
+                self.misses += 1
+        if running is not None:  # same call is running already
+            return running.result(), True
+        try:
+            result = foo()
+        except BaseException as exc:
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+            future.set_exception(exc)
+            raise
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, result)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last = False)
+        future.set_result(result)
+        return result, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._in_flight.clear()
+            self._generation += 1
+
+    def stats(self) -> dict:
+        """dict{hits,misses,merged,entries,hit_ratio}, merged calls count as hits in hit_ratio"""
+        with self._lock:
+            hits = self.hits + self.merged
+            total = hits + self.misses
+            return dict({
+                "hits": self.hits,
+                "misses": self.misses,
+                "merged": self.merged,
+                "entries": len(self._entries),
+                "hit_ratio": hits / total if total else 0.0,
+            })
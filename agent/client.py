@@ -1,11 +1,23 @@
 import os
-from xmlrpc.client import ServerProxy
+import socket
 from uuid import uuid4
 import time
-from datetime import datetime
 import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+from xmlrpc.client import ProtocolError
 
-from .resolver import RPCResolver
+from .resolver import RPCResolver, PART_SUFFIX
+from .transport import PooledTransport, get_pool
+from . import compression
+from . import events
+from .log import get_writer
+from .retry import RetryPolicy
+from .breaker import CircuitBreaker, HostUnavailableError
+
+
+TIMEOUT = 30.0  # default time to wait for a response, long methods should be run as jobs
 
 
 class RPCClient(RPCResolver):
@@ -14,97 +26,338 @@ class RPCClient(RPCResolver):
     Syncronous RPC Client
 
     returns called method result or raise RPCCallError
+
+    Connections are taken from keep-alive pool shared by all clients of the same host,
+    see transport.ConnectionPool for pool_size and pool_idle_timeout
+
+    Calls are sent in binary format (see codec) if server supports it,
+    binary = False forces xml
+
+    Logs go to <log_out_dir>/RPCClient_<remote_host_name>.log in background,
+    log_options are passed to log.LogWriter
+
+    Failed calls are retried according to retry (see retry.RetryPolicy),
+    timeout limits waiting for the server to respond (None - wait forever, run long methods
+    with _submit instead), connect_timeout - for connection; retry deadline lowers timeout further
+
+    With breaker (see breaker.CircuitBreaker) calls fail with HostUnavailableError
+    right away while the host is considered down
+
+    Requests larger than compress_threshold bytes are compressed with compress_level
+    if server supports it, see transport.PooledTransport
+
+    With unix_socket, connects to agent on the same host through that Unix domain socket
+    (see RPCServer), bytes larger than shm_threshold are passed through shared memory
     """
 
-    def __init__(self, host, port, remote_host_name = None, log_out_dir = None, f_print_logs = False):
+    def __init__(self, host, port, remote_host_name = None, log_out_dir = None, f_print_logs = False,
+                 pool_size = 4, pool_idle_timeout = 10.0, binary = True, log_options = None,
+                 retry: RetryPolicy = None, timeout: float = TIMEOUT, connect_timeout: float = 5.0,
+                 breaker: CircuitBreaker = None, compress_threshold: int = compression.THRESHOLD,
+                 compress_level: int = 6, unix_socket: str = None, shm_threshold: int = 64 * 1024):
         self._remote_host_name = remote_host_name
-        self._file = None
-        self._f_print_logs = f_print_logs
+        log_path = None
         if log_out_dir:
-            self._file = open(os.path.join(log_out_dir, f"RPCClient_{self._remote_host_name}.log"),
-                              "w", encoding = "utf-8")
+            log_path = os.path.join(log_out_dir, f"RPCClient_{self._remote_host_name}.log")
+        self._logger = get_writer(log_path, f_print_logs, mode = "w", **(log_options or {}))
+        self._log_source = f"RPCClient <{remote_host_name or host}>"
+        self._methods = {}  # name : RPCMethodCall
         self._host = host
-        self._uri = f"http://{host}:{port}/"
-        self._proxy = ServerProxy(self._uri, encoding = "utf-8", allow_none = True,
-                                  use_datetime = True, use_builtin_types = True)
-
-    def __del__(self):
-        if self._file:
-            self._file.close()
-        with self._proxy:
-            pass
-
-    def _log(self, msg):
-        if self._file or self._f_print_logs:
-            try:
-                msg = (f"{datetime.now()}: RPCClient "
-                       f"<{self._remote_host_name or self._host}>: {msg}\n")
-                if self._file:
-                    self._file.write(msg)
-                if self._f_print_logs:
-                    print(msg)
-            except Exception as exc:
-                print(exc)
+        self._uri = f"http+unix://{unix_socket}" if unix_socket else f"http://{host}:{port}/"
+        self._retry = retry or RetryPolicy()
+        self._breaker = breaker
+        self._timeout = timeout
+        self._pool = get_pool(host, port, pool_size, pool_idle_timeout, connect_timeout, unix_socket)
+        self._transport = PooledTransport(self._pool, use_datetime = True,
+                                          use_builtin_types = True, binary = binary,
+                                          compress_threshold = None if unix_socket else compress_threshold,
+                                          compress_level = compress_level,
+                                          shm_threshold = shm_threshold)
+
+    def _log(self, id_, method, event, **fields):
+        if self._logger:
+            self._logger.log(self._log_source, id_, method, event, **fields)
+
+    def _request(self, method, params, timeout = None):
+        return self._transport.call(method, params, timeout)
 
     def _resolve_attr(self, name):
-        return RPCMethodCall(self._proxy, self, name)
+        return RPCMethodCall(self, name)
+
+    def _compression_stats(self) -> dict:
+        """Bytes saved by compressing requests, see compression.CompressionStats.stats"""
+        return self._transport.compression.stats()
+
+    def _exec_stream(self, args, timeout = 1.0, **kwargs):
+        """Runs os.exec_stream, yields tuples (stream_name, chunk) as output arrives
+
+        stream_name is 'stdout' or 'stderr', kwargs are passed to os.exec_stream.
+        Process return code is the generator return value
+        """
+        handle = RPCMethodCall(self, "os.exec_stream")(args, **kwargs)
+        try:
+            while True:
+                ret = RPCMethodCall(self, "os.read_stream")(handle, timeout)
+                for name in ("stdout", "stderr"):
+                    if ret[name]:
+                        yield name, ret[name]
+                if ret["eof"]:
+                    return ret["return_code"]
+        finally:
+            RPCMethodCall(self, "os.close_stream")(handle)
+
+    def _upload(self, local_path, remote_path, chunk_size = 4 * 1024 * 1024):
+        """Uploads file in chunks, resumes unfinished upload of the same file
+
+        Returns uploaded file size
+        """
+        with open(local_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = RPCMethodCall(self, "files.stat")(remote_path)["part_size"]
+            offset = min(offset - offset % chunk_size, size - size % chunk_size)
+            if offset:  # make sure unfinished upload is of the same file
+                f.seek(offset - chunk_size)
+                crc32 = RPCMethodCall(self, "files.checksum")(
+                    remote_path + PART_SUFFIX, offset - chunk_size, chunk_size)
+                if zlib.crc32(f.read(chunk_size)) != crc32:
+                    offset = 0
+            f.seek(offset)
+            data = f.read(chunk_size)
+            while True:  # empty chunk still creates an empty file
+                RPCMethodCall(self, "files.write_chunk")(remote_path, offset, data, zlib.crc32(data))
+                offset += len(data)
+                data = f.read(chunk_size)
+                if not data:
+                    break
+        RPCMethodCall(self, "files.commit")(remote_path, size)
+        return size
+
+    def _download(self, remote_path, local_path, chunk_size = 4 * 1024 * 1024):
+        """Downloads file in chunks, resumes unfinished download of the same file
+
+        Returns downloaded file size
+        """
+        part = local_path + PART_SUFFIX
+        with open(part, "r+b" if os.path.isfile(part) else "wb") as f:
+            offset = os.fstat(f.fileno()).st_size
+            if offset:
+                size = RPCMethodCall(self, "files.stat")(remote_path)["size"]
+                offset = min(offset - offset % chunk_size, size - size % chunk_size)
+            if offset:  # make sure unfinished download is of the same file
+                f.seek(offset - chunk_size)
+                crc32 = RPCMethodCall(self, "files.checksum")(remote_path, offset - chunk_size, chunk_size)
+                if zlib.crc32(f.read(chunk_size)) != crc32:
+                    offset = 0
+            f.seek(offset)
+            while True:
+                ret = RPCMethodCall(self, "files.read_chunk")(remote_path, offset, chunk_size)
+                if zlib.crc32(ret["data"]) != ret["crc32"]:
+                    raise ValueError(f"{remote_path}: chunk at {offset} checksum mismatch")
+                f.write(ret["data"])
+                offset += len(ret["data"])
+                if ret["eof"]:
+                    break
+            f.truncate()
+        os.replace(part, local_path)
+        return offset
+
+    def _submit(self, method: str, *args, **kwargs):
+        """Runs method as a job on the server, returns RPCJob right away
+
+        job = client._submit("vm.wait_ready", "vm1")
+        job.result()
+        """
+        job_id = RPCMethodCall(self, "_job_submit")(method, args, kwargs)
+        return RPCJob(self, method, job_id)
+
+    def _wait_jobs(self, jobs: list, timeout: float = None) -> bool:
+        """Waits for all jobs of this client with one long-poll request at a time
+
+        Server answers right away if it cannot spare a worker for waiting (e.g. serial one),
+        then it is polled with growing intervals up to JOB_POLL_INTERVAL
+
+        Returns True if all jobs finished, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = dict({job.job_id: job for job in jobs if job._status is None})
+        interval = 0.1
+        while pending:
+            poll = JOB_POLL if self._timeout is None else min(JOB_POLL, self._timeout / 2)
+            if deadline is not None:
+                poll = max(0.0, min(poll, deadline - time.monotonic()))
+            started = time.monotonic()
+            statuses = RPCMethodCall(self, "_job_wait")(list(pending), poll)
+            finished = [job_id for job_id, status in statuses.items() if status["finished"]]
+            for job_id in finished:
+                pending.pop(job_id)._status = statuses[job_id]
+            if pending and deadline is not None and time.monotonic() >= deadline:
+                return False
+            if pending and not finished and time.monotonic() - started < poll / 2:
+                interval = min(interval * 2, JOB_POLL_INTERVAL)  # server did not wait
+                time.sleep(interval if deadline is None else
+                           max(0.0, min(interval, deadline - time.monotonic())))
+            else:
+                interval = 0.1
+        return True
+
+    def _events(self, *topics: str):
+        """Subscribes to server events of topics, returns RPCEventStream
+
+        Topics are fnmatch-style patterns, all events if none given
+
+        with client._events("job.*", "watch.*") as stream:
+            for event in stream:
+                ...
+        """
+        return RPCEventStream(self, topics or ("*",))
+
+    def _watch(self, method: str, args = (), kwargs = None, interval: float = 1.0,
+               topic: str = None, ttl: float = 3600.0) -> str:
+        """Makes server call method every interval seconds and publish event when result changes
+
+        Replaces polling, e.g. instead of waiting in vm.wait_ready:
+            watch_id = client._watch("vm.get_property", ["vm1", "state"], topic = "vm1.state")
+            for event in client._events("vm1.state"): ...
+
+        Returns watch id, see events.Watches.add
+        """
+        return RPCMethodCall(self, "_event_watch")(method, args, kwargs, interval, topic, ttl)
+
+    def _unwatch(self, watch_id: str) -> bool:
+        return RPCMethodCall(self, "_event_unwatch")(watch_id)
+
+    def _publish(self, topic: str, data = None):
+        """Publishes event to subscribers of this server"""
+        return RPCMethodCall(self, "_event_publish")(topic, data)
+
+    def _batch(self):
+        """Returns RPCBatch, calls made through it are sent in one request
+
+        with client._batch() as batch:
+            ret = batch.examples.foo_no_args()
+        ret.result()
+        """
+        return RPCBatch(self)
 
     def __getattribute__(self, name: str):  # skipping usual attr resolving
         if name.startswith("_"):
             return object.__getattribute__(self, name)
-        return self._resolve_attr(name)
+        methods = object.__getattribute__(self, "_methods")
+        try:
+            return methods[name]
+        except KeyError:
+            method = methods[name] = self._resolve_attr(name)
+            return method
+
+    def _threaded(self, executor: ThreadPoolExecutor = None):
+        """Returns RPCClient_T sharing connections, log, retry policy and breaker of this client"""
+        client = object.__new__(RPCClient_T)
+        client.__dict__.update(self.__dict__)
+        client._methods = {}
+        client._executor = executor or get_executor()
+        return client
+
+
+_executors = {}  # max_workers : ThreadPoolExecutor
+_executors_lock = threading.Lock()
+
+
+def get_executor(max_workers: int = 32) -> ThreadPoolExecutor:
+    """Returns thread pool shared by all RPCClient_T with the same max_workers"""
+    with _executors_lock:
+        executor = _executors.get(max_workers)
+        if executor is None:
+            executor = _executors[max_workers] = ThreadPoolExecutor(
+                max_workers, thread_name_prefix = "rpc-call")
+        return executor
 
 
 class RPCClient_T(RPCClient):
     """Asyncronous version of RPCClient
 
-    Method call returns started thread
+    Method call returns RPCFuture, calls run on executor (shared by default, see get_executor)
 
-    The thread has join() method which returns result, or raise RPCCallError
+    RPCFuture.result() returns result, or raise RPCCallError
     """
 
+    def __init__(self, *args, executor: ThreadPoolExecutor = None, max_workers: int = 32, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = executor or get_executor(max_workers)
+
     def _resolve_attr(self, name):
-        return RPCMethodCall_T(self._proxy, self, name)
+        return RPCMethodCall_T(self, name)
 
 
 class RPCMethodCall:
-    """Used to control rpc-proxy methods call"""
+    """Used to control rpc methods call
+
+    Resolved nested methods are cached, so the same object
+    is returned for the same method path every time.
+    id_ is the id of the last call
+    """
 
-    def __init__(self, proxy: ServerProxy, client: RPCClient, name: str):
-        self.proxy = getattr(proxy, name)
+    def __init__(self, client: RPCClient, name: str):
         self.method = name
         self.client = client
         self.id_ = 0
+        self.children = {}
 
     def __getattr__(self, name: str):
-        self.proxy = getattr(self.proxy, name)
-        self.method += f".{name}"
-        return self
+        if name.startswith("__"):
+            raise AttributeError(name)
+        try:
+            return self.children[name]
+        except KeyError:
+            child = self.children[name] = self.__class__(self.client, f"{self.method}.{name}")
+            return child
 
     def __str__(self):
         return f'{self.__class__.__name__}: id={self.id_} method={self.method}'
 
     def _call(self, *args, **kwargs):
-        self.id_ = uuid4().hex
-        self.client._log(f'id={self.id_}:\n\tmethod: {self.method}\n\targs={args}\n\tkwargs={kwargs}')
-        tries = 10
-        while tries:
-            tries -= 1
+        id_ = self.id_ = uuid4().hex
+        client = self.client
+        client._log(id_, self.method, "call", args = args, kwargs = kwargs)
+        policy = client._retry
+        breaker = client._breaker
+        deadline = policy.deadline and time.monotonic() + policy.deadline
+        attempt = 0
+        while True:
+            params = (args, kwargs, id_)
+            timeout = client._timeout
+            if deadline:
+                remaining = deadline - time.monotonic()
+                params += ({"deadline": remaining},)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            if breaker:
+                if not breaker.allow():
+                    raise HostUnavailableError(client._remote_host_name or client._host,
+                                               breaker.retry_in())
+                breaker.enter()
+            started = time.monotonic()
             try:
-                ret = self.proxy(args, kwargs, self.id_)
+                ret = client._request(self.method, params, timeout)
+                if breaker:
+                    breaker.record(True, time.monotonic() - started)
                 break
-            except ConnectionRefusedError as ex:
-                self.client._log(f'id={self.id_}:\n{ex}\nurl={self.client._uri}')
-                if not tries:
-                    raise ex
-                time.sleep(5)
-                continue
+            except Exception as ex:
+                if breaker:
+                    # busy host that rejected the call is up, it closes half-open breaker as well
+                    breaker.record(isinstance(ex, ProtocolError) and ex.errcode == 503)
+                delay = policy.delay(attempt, ex)
+                if delay is None or (deadline and time.monotonic() + delay >= deadline):
+                    raise
+                client._log(id_, self.method, "retry", error = ex, url = client._uri, delay = delay)
+                time.sleep(delay)
+                attempt += 1
+            finally:
+                if breaker:
+                    breaker.exit()
         tb = ret.get("traceback")
         returns = ret.get("returns", None)
-        self.client._log(f'id={self.id_}:\n\t'
-                         + "\n\t".join(f"{k}: {v}" for k, v in ret.items()))
+        client._log(id_, self.method, "error" if tb else "success", **ret)
         if tb:
-            raise RPCCallError(self.method, tb, self.id_, self.client._remote_host_name)
+            raise RPCCallError(self.method, tb, id_, client._remote_host_name)
         return returns
 
     def __call__(self, *args, **kwargs):
@@ -114,41 +367,239 @@ class RPCMethodCall:
 class RPCMethodCall_T(RPCMethodCall):
     """Threaded version of RPCMethodCall
 
-    Returns started thread instead result
+    Returns RPCFuture instead result, call is queued on client executor
 
-    This thread has join() method which returns result, or raise exception
+    RPCFuture.result() returns result, or raise exception
     """
 
     def __call__(self, *args, **kwargs):
-        t = CMethodThread(self, self._call, args, kwargs)
-        t.start()
-        return t
+        future = RPCFuture(self)
+        self.client._executor.submit(future._run, self._call, args, kwargs)
+        return future
+
 
+class RPCFuture(Future):
+    """concurrent.futures.Future of RPCMethodCall_T call
 
-class CMethodThread(threading.Thread):
+    join() is kept as alias of result()
+    """
 
-    def __init__(self, rpc: RPCMethodCall_T, foo, args, kwargs):
-        super().__init__(daemon = True)
-        assert callable(foo), f"{foo} is not callable"
-        self.foo = foo
-        self.args = args
-        self.kwargs = kwargs
-        self.ret = None
-        self.exc = None
+    def __init__(self, rpc: RPCMethodCall_T):
+        super().__init__()
         self.rpc = rpc
 
+    def __str__(self):
+        return f"{self.__class__.__name__}: {self.rpc}"
+
+    def _run(self, foo, args, kwargs):
+        if not self.set_running_or_notify_cancel():
+            return  # cancelled while queued
+        try:
+            self.set_result(foo(*args, **kwargs))
+        except BaseException as exc:
+            self.set_exception(exc)
+
     def join(self, timeout = None):
-        print(f"\tWaiting for thread {self.rpc}")
-        super().join(timeout)
-        if self.exc:
-            raise self.exc
-        return self.ret
+        return self.result(timeout)
+
+
+JOB_POLL = 20.0  # long-poll duration, server caps it with jobs.MAX_WAIT
+JOB_POLL_INTERVAL = 2.0  # max interval between polls if server does not wait
+
+
+class RPCJob:
+    """Method call running as a job on the server, see RPCClient._submit
+
+    result() returns called method result or raise RPCCallError
+    """
+
+    def __init__(self, client: RPCClient, method: str, job_id: str):
+        self.client = client
+        self.method = method
+        self.job_id = job_id
+        self._status = None  # set once finished
+
+    def __str__(self):
+        return f'{self.__class__.__name__}: job_id={self.job_id} method={self.method}'
+
+    @property
+    def done(self):
+        return self._status is not None
+
+    def status(self) -> dict:
+        """dict{method,state,submitted,finished}, see jobs.JobQueue.status"""
+        if self._status:
+            return self._status
+        status = RPCMethodCall(self.client, "_job_status")(self.job_id)
+        if status["finished"]:
+            self._status = status
+        return status
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits for job to finish, returns False on timeout"""
+        return self.client._wait_jobs([self], timeout)
+
+    def cancel(self) -> bool:
+        """Cancels job if it has not started yet"""
+        return RPCMethodCall(self.client, "_job_cancel")(self.job_id)
+
+    def result(self, timeout: float = None):
+        if not self.wait(timeout):
+            raise TimeoutError(f"{self} has not finished in {timeout}s")
+        if self._status["state"] != "done":
+            raise RPCCallError(self.method, f"job {self._status['state']}", self.job_id,
+                               self.client._remote_host_name)
+        ret = self._status["ret"]
+        tb = ret.get("traceback")
+        if tb:
+            raise RPCCallError(self.method, tb, self.job_id, self.client._remote_host_name)
+        return ret.get("returns", None)
 
-    def run(self):
+
+class RPCEventStream:
+    """Events pushed by the server over one long-lived connection, see RPCClient._events
+
+    Iterating yields event dicts {seq,topic,time,data} as they arrive, ends once closed,
+    raises OSError or EOFError if connection is lost. Server sends heartbeats,
+    so a silent connection is considered lost after 3 missed ones
+    """
+
+    def __init__(self, client: RPCClient, topics: tuple):
+        self.client = client
+        self.topics = topics
+        self.closed = False
+        conn = client._pool.connect()
+        try:
+            conn.request("GET", "/events?topics=" + quote(",".join(topics)))
+            self._sock = conn.sock
+            response = conn.getresponse()
+            if response.status != 200:
+                raise ProtocolError(client._uri, response.status, response.reason,
+                                    dict(response.getheaders()))
+            self._sock.settimeout(events.HEARTBEAT * 3)
+        except:
+            conn.close()
+            raise
+        self._conn = conn
+        self._response = response
+
+    def __str__(self):
+        return f'{self.__class__.__name__}: host={self.client._remote_host_name} topics={",".join(self.topics)}'
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        while True:
+            try:
+                event = events.read_frame(self._response)
+            except (OSError, EOFError, ValueError):
+                if self.closed:
+                    raise StopIteration
+                raise
+            if event is not None:
+                return event
+
+    def close(self):
+        """Ends the stream, may be called from another thread than the one iterating"""
+        if self.closed:
+            return
+        self.closed = True
         try:
-            self.ret = self.foo(*self.args, **self.kwargs)
-        except Exception as exc:
-            self.exc = exc
+            self._sock.shutdown(socket.SHUT_RDWR)  # wakes up reader
+        except OSError:
+            pass
+        self._response.close()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RPCBatch(RPCResolver):
+    """Collects method calls and sends them in one request on flush
+
+    Each call returns RPCBatchResult, flushed on context manager exit or by _flush()
+    """
+
+    def __init__(self, client: RPCClient):
+        self._client = client
+        self._calls = []
+        self._results = []
+
+    def __getattribute__(self, name: str):
+        if name.startswith("_"):
+            return object.__getattribute__(self, name)
+        return RPCBatchCall(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._flush()
+
+    def _add(self, method, args, kwargs):
+        result = RPCBatchResult(method, uuid4().hex, self._client._remote_host_name)
+        self._calls.append([method, args, kwargs, result.id_])
+        self._results.append(result)
+        return result
+
+    def _flush(self):
+        """Sends queued calls, returns list of RPCBatchResult"""
+        calls, results = self._calls, self._results
+        self._calls, self._results = [], []
+        if not calls:
+            return results
+        rets = RPCMethodCall(self._client, "_batch")(calls)
+        for result, ret in zip(results, rets):
+            result._ret = ret
+        return results
+
+
+class RPCBatchCall:
+    """Queues method call in RPCBatch"""
+
+    def __init__(self, batch: RPCBatch, name: str):
+        self.batch = batch
+        self.method = name
+
+    def __getattr__(self, name: str):
+        self.method += f".{name}"
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self.batch._add(self.method, args, kwargs)
+
+
+class RPCBatchResult:
+    """Result of a call made through RPCBatch
+
+    result() returns called method result or raise RPCCallError
+    """
+
+    def __init__(self, method, id_, host_name):
+        self.method = method
+        self.id_ = id_
+        self.host_name = host_name
+        self._ret = None
+
+    def __str__(self):
+        return f'{self.__class__.__name__}: id={self.id_} method={self.method}'
+
+    @property
+    def done(self):
+        return self._ret is not None
+
+    def result(self):
+        assert self.done, f"{self} batch was not flushed"
+        tb = self._ret.get("traceback")
+        if tb:
+            raise RPCCallError(self.method, tb, self.id_, self.host_name)
+        return self._ret.get("returns", None)
 
 
 class RPCCallError(Exception):
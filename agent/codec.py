@@ -0,0 +1,258 @@
+"""Compact binary codec, alternative to xmlrpc XML marshalling
+
+Every value is a one byte tag followed by its payload,
+sizes are 4 byte big-endian unsigned ints:
+
+    N None, T True, F False
+    i int64, I bigger int as decimal string, d float64
+    s utf-8 str, b bytes, D datetime as iso string
+    l list (count, items), m dict (count, key, value, ...)
+    M bytes passed in shared memory (name as utf-8 str, size)
+
+Handles the same types as xmlrpc client/server with
+use_datetime/use_builtin_types: datetime and bytes are returned as is,
+tuples become lists, objects are sent as dict of their __dict__
+
+Between processes of one host, bytes larger than shm_threshold are put to
+shared memory segments instead of the body. The receiver copies them out
+and unlinks the segments, so each encoded body has to be decoded exactly once,
+otherwise sender has to unlink its segments (see release). Sender which cannot tell
+whether body has been decoded unlinks segments left after a grace period (see release_later)
+"""
+import collections
+import struct
+import threading
+import time
+from datetime import datetime
+from xmlrpc.client import Binary, DateTime
+
+NAME = "bin1"
+CONTENT_TYPE = "application/x-agent-rpc"
+
+_size = struct.Struct(">I")
+_int = struct.Struct(">q")
+_float = struct.Struct(">d")
+_INT_MIN = -2 ** 63
+_INT_MAX = 2 ** 63 - 1
+
+SHM_GRACE = 60.0  # seconds segments of a sent body are left for the receiver by release_later
+
+_sent = collections.deque()  # (due, segments) of bodies released by release_later
+_sent_lock = threading.Lock()
+_sent_reaper = None
+
+
+def dumps(obj, shm_threshold: int = None, segments: list = None) -> bytes:
+    """Encodes obj, bytes larger than shm_threshold are put to shared memory
+
+    Created SharedMemory segments are appended to segments if it is given
+    """
+    out = []
+    if shm_threshold is None:
+        _encode(obj, out.append)
+    else:
+        _encode(obj, out.append, shm_threshold, [] if segments is None else segments)
+    return b"".join(out)
+
+
+def loads(data: bytes, shm: bool = False, reserve = None):
+    """Decodes data, shared memory references are accepted only if shm is set
+
+    reserve(size) is called before each shared memory segment is copied out,
+    it may raise to reject the segment
+    """
+    view = memoryview(data)
+    obj, pos = _decode(view, 0, (reserve or _no_reserve) if shm else None)
+    if pos != len(view):
+        raise ValueError(f"{len(view) - pos} bytes of trailing data")
+    return obj
+
+
+def release(segments: list, unlink: bool = True):
+    """Closes segments created by dumps once body is sent
+
+    unlink is needed if body might not have been decoded by the receiver
+    """
+    if unlink and segments:
+        from multiprocessing import resource_tracker
+    for segment in segments:
+        segment.close()
+        if unlink:
+            # unlink() unregisters segment, which was unregistered when created
+            resource_tracker.register(segment._name, "shared_memory")
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                resource_tracker.unregister(segment._name, "shared_memory")  # receiver unlinked it
+
+
+def release_later(segments: list, grace: float = SHM_GRACE):
+    """Closes segments of a sent body, unlinks those not unlinked by the receiver
+    after grace seconds, e.g. because it timed out or disconnected before decoding the body"""
+    global _sent_reaper
+    if not segments:
+        return
+    for segment in segments:
+        segment.close()
+    with _sent_lock:
+        _sent.append((time.monotonic() + grace, segments))
+        if _sent_reaper is None:
+            _sent_reaper = threading.Thread(target = _reap_sent, daemon = True, name = "rpc-shm-reaper")
+            _sent_reaper.start()
+
+
+def _reap_sent():
+    global _sent_reaper
+    while True:
+        with _sent_lock:
+            if not _sent:
+                _sent_reaper = None
+                return
+            due = _sent[0][0]
+        time.sleep(max(0.0, due - time.monotonic()))
+        with _sent_lock:
+            expired = []
+            while _sent and _sent[0][0] <= time.monotonic():
+                expired.extend(_sent.popleft()[1])
+        release(expired)
+
+
+def _to_shm(data, segments: list) -> bytes:
+    from multiprocessing import shared_memory, resource_tracker
+    segment = shared_memory.SharedMemory(create = True, size = len(data))
+    # receiver unlinks the segment, sender must not unlink it at exit
+    resource_tracker.unregister(segment._name, "shared_memory")
+    segment.buf[:len(data)] = data
+    segments.append(segment)
+    name = segment.name.encode("utf-8")
+    return b"M" + _size.pack(len(name)) + name + _size.pack(len(data))
+
+
+def _no_reserve(size: int):
+    pass
+
+
+def _from_shm(name: str, size: int) -> bytes:
+    from multiprocessing import shared_memory
+    segment = shared_memory.SharedMemory(name)
+    try:
+        return bytes(segment.buf[:size])
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+def _encode(obj, write, shm_threshold = None, segments = None):
+    t = type(obj)
+    if t is str:
+        b = obj.encode("utf-8")
+        write(b"s" + _size.pack(len(b)))
+        write(b)
+    elif obj is None:
+        write(b"N")
+    elif t is bool:
+        write(b"T" if obj else b"F")
+    elif t is int:
+        if _INT_MIN <= obj <= _INT_MAX:
+            write(b"i" + _int.pack(obj))
+        else:
+            b = str(obj).encode()
+            write(b"I" + _size.pack(len(b)))
+            write(b)
+    elif t is float:
+        write(b"d" + _float.pack(obj))
+    elif t is dict:
+        write(b"m" + _size.pack(len(obj)))
+        for k, v in obj.items():
+            _encode(k, write, shm_threshold, segments)
+            _encode(v, write, shm_threshold, segments)
+    elif t is list or t is tuple:
+        write(b"l" + _size.pack(len(obj)))
+        for v in obj:
+            _encode(v, write, shm_threshold, segments)
+    elif t is bytes or t is bytearray or t is memoryview:
+        if shm_threshold is not None and len(obj) > shm_threshold:
+            write(_to_shm(obj, segments))
+        else:
+            write(b"b" + _size.pack(len(obj)))
+            write(obj)
+    elif t is datetime:
+        b = obj.isoformat().encode()
+        write(b"D" + _size.pack(len(b)))
+        write(b)
+    else:
+        _encode(_convert(obj), write, shm_threshold, segments)
+
+
+def _convert(obj):
+    """Converts subclasses and xmlrpc wrappers to a type _encode knows"""
+    if isinstance(obj, datetime):
+        return datetime.fromisoformat(obj.isoformat())
+    for base in (int, float, str, bytes, dict, list, tuple):
+        if isinstance(obj, base):
+            return base(obj)
+    if isinstance(obj, Binary):
+        return obj.data
+    if isinstance(obj, DateTime):
+        return datetime.strptime(obj.value, "%Y%m%dT%H:%M:%S")
+    if hasattr(obj, "__dict__"):
+        return vars(obj)
+    raise TypeError(f"cannot marshal {type(obj)} objects")
+
+
+def _decode(data: memoryview, pos: int, shm = None):
+    tag = data[pos]
+    pos += 1
+    if tag == 0x73:  # s
+        size, = _size.unpack_from(data, pos)
+        pos += 4
+        return str(data[pos:pos + size], "utf-8"), pos + size
+    if tag == 0x69:  # i
+        return _int.unpack_from(data, pos)[0], pos + 8
+    if tag == 0x6D:  # m
+        count, = _size.unpack_from(data, pos)
+        pos += 4
+        obj = {}
+        for _ in range(count):
+            k, pos = _decode(data, pos, shm)
+            obj[k], pos = _decode(data, pos, shm)
+        return obj, pos
+    if tag == 0x6C:  # l
+        count, = _size.unpack_from(data, pos)
+        pos += 4
+        obj = []
+        for _ in range(count):
+            v, pos = _decode(data, pos, shm)
+            obj.append(v)
+        return obj, pos
+    if tag == 0x4E:  # N
+        return None, pos
+    if tag == 0x54:  # T
+        return True, pos
+    if tag == 0x46:  # F
+        return False, pos
+    if tag == 0x64:  # d
+        return _float.unpack_from(data, pos)[0], pos + 8
+    if tag == 0x62:  # b
+        size, = _size.unpack_from(data, pos)
+        pos += 4
+        return bytes(data[pos:pos + size]), pos + size
+    if tag == 0x44:  # D
+        size, = _size.unpack_from(data, pos)
+        pos += 4
+        return datetime.fromisoformat(str(data[pos:pos + size], "ascii")), pos + size
+    if tag == 0x49:  # I
+        size, = _size.unpack_from(data, pos)
+        pos += 4
+        return int(str(data[pos:pos + size], "ascii")), pos + size
+    if tag == 0x4D:  # M
+        if not shm:
+            raise ValueError(f"shared memory reference at {pos - 1} is not allowed")
+        size, = _size.unpack_from(data, pos)
+        pos += 4
+        name = str(data[pos:pos + size], "utf-8")
+        pos += size
+        size, = _size.unpack_from(data, pos)
+        shm(size)
+        return _from_shm(name, size), pos + 4
+    raise ValueError(f"unknown tag {tag:#x} at {pos - 1}")
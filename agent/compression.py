@@ -0,0 +1,90 @@
+import threading
+import zlib
+
+ENCODINGS = ("gzip", "deflate")  # in order of preference
+THRESHOLD = 1400  # bodies smaller than that are not worth compressing
+
+
+def compress(data: bytes, encoding: str, level: int = 6) -> bytes:
+    """Compresses body for Content-Encoding gzip or deflate"""
+    wbits = 31 if encoding == "gzip" else 15
+    obj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return obj.compress(data) + obj.flush()
+
+
+class SizeLimitExceeded(ValueError):
+    """Raised when decompressed body gets larger than allowed"""
+
+
+class Decompressor:
+    """Decompresses body of Content-Encoding gzip or deflate chunk by chunk
+
+    Raises ValueError if body is broken, SizeLimitExceeded if output exceeds max_size bytes
+    """
+
+    def __init__(self, encoding: str, max_size: int = None):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.size = 0  # of output so far
+        self._obj = zlib.decompressobj(31 if encoding == "gzip" else 15)
+
+    def feed(self, chunk: bytes) -> bytes:
+        try:
+            if self.max_size is None:
+                out = self._obj.decompress(chunk)
+            else:  # output is bounded, so a small bomb cannot inflate in memory
+                out = self._obj.decompress(chunk, self.max_size - self.size + 1)
+        except zlib.error as exc:
+            raise ValueError(f"error decoding {self.encoding} content: {exc}")
+        self.size += len(out)
+        if self.max_size is not None and self.size > self.max_size:
+            raise SizeLimitExceeded(f"{self.encoding} content exceeds {self.max_size} bytes")
+        return out
+
+    def close(self):
+        """Checks that body has ended"""
+        if not self._obj.eof:
+            raise ValueError(f"error decoding {self.encoding} content: truncated")
+
+
+def decompress(data: bytes, encoding: str, max_size: int = None) -> bytes:
+    """Decompresses body of Content-Encoding gzip or deflate, raises ValueError if body is broken,
+    SizeLimitExceeded if it is larger than max_size bytes once decompressed"""
+    decompressor = Decompressor(encoding, max_size)
+    data = decompressor.feed(data)
+    decompressor.close()
+    return data
+
+
+def pick(accepted) -> str:
+    """Returns preferred encoding of accepted ones, None if there is no common one"""
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+class CompressionStats:
+    """Counts bodies sent compressed and bytes saved by that"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bodies = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+
+    def add(self, raw_size: int, sent_size: int):
+        with self._lock:
+            self.bodies += 1
+            self.raw_bytes += raw_size
+            self.sent_bytes += sent_size
+
+    def stats(self) -> dict:
+        """dict{bodies,raw_bytes,sent_bytes,saved_bytes} of compressed bodies"""
+        with self._lock:
+            return dict({
+                "bodies": self.bodies,
+                "raw_bytes": self.raw_bytes,
+                "sent_bytes": self.sent_bytes,
+                "saved_bytes": self.raw_bytes - self.sent_bytes,
+            })
@@ -0,0 +1,222 @@
+import fnmatch
+import itertools
+import queue
+import struct
+import threading
+import time
+from uuid import uuid4
+
+from . import codec
+
+CONTENT_TYPE = "application/x-agent-events"
+HEARTBEAT = 5.0  # seconds between empty frames sent to idle subscribers
+CHECK_INTERVAL = 0.5  # seconds between checks whether idle subscriber has disconnected
+
+_size = struct.Struct(">I")
+
+
+def frame(event: dict) -> bytes:
+    """Event stream frame: 4 byte big-endian size followed by codec encoded event,
+    zero size frame is a heartbeat"""
+    data = codec.dumps(event) if event is not None else b""
+    return _size.pack(len(data)) + data
+
+
+def read_frame(stream):
+    """Reads frame from file-like stream, returns event, None for heartbeat
+
+    Raises EOFError if stream ended
+    """
+    header = stream.read(_size.size)
+    if len(header) < _size.size:
+        raise EOFError("event stream closed")
+    size, = _size.unpack(header)
+    if not size:
+        return None
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError("event stream closed")
+    return codec.loads(data)
+
+
+class Subscription:
+    """Events of matching topics queued for one subscriber
+
+    Queue is bounded, events above that are dropped and counted
+    """
+
+    def __init__(self, patterns: list, queue_size: int):
+        self.patterns = patterns
+        self.dropped = 0
+        self.closed = False
+        self._queue = queue.Queue(queue_size)
+
+    def matches(self, topic: str) -> bool:
+        return any(fnmatch.fnmatchcase(topic, pattern) for pattern in self.patterns)
+
+    def put(self, event: dict):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)  # wakes up reader
+        except queue.Full:
+            pass
+
+    def get(self, timeout: float):
+        """Returns next event, None if there was none within timeout"""
+        try:
+            return self._queue.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """Publishes events to subscribers of matching topics
+
+    Topic patterns are fnmatch-style, e.g. 'job.*'
+
+    Args:
+        :max_subscribers: subscriptions allowed at once, each holds a server worker,
+            so they are limited by admission.Admission max_held as well
+        :queue_size: events queued per subscriber
+    """
+
+    def __init__(self, max_subscribers: int = 16, queue_size: int = 1000):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions = []
+        self._seq = itertools.count(1)
+        self.published = 0
+        self.closed = False
+
+    def subscribe(self, patterns: list) -> Subscription:
+        """Returns Subscription, None if there are max_subscribers already or bus is closed"""
+        with self._lock:
+            if self.closed or len(self._subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(patterns, self.queue_size)
+            self._subscriptions.append(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.remove(subscription)
+
+    def publish(self, topic: str, data = None):
+        """Sends event {seq,topic,time,data} to subscribers of the topic"""
+        with self._lock:
+            event = dict({"seq": next(self._seq), "topic": topic, "time": time.time(), "data": data})
+            self.published += 1
+            for subscription in self._subscriptions:
+                if subscription.matches(topic):
+                    subscription.put(event)
+
+    def close(self):
+        """Closes all subscriptions, their streams end"""
+        with self._lock:
+            self.closed = True
+            for subscription in self._subscriptions:
+                subscription.close()
+
+    def stats(self) -> dict:
+        """dict{published,subscribers,dropped}"""
+        with self._lock:
+            return dict({
+                "published": self.published,
+                "subscribers": len(self._subscriptions),
+                "dropped": sum(s.dropped for s in self._subscriptions),
+            })
+
+
+class _Watch:
+
+    def __init__(self, method: str, args, kwargs, interval: float, topic: str, expires: float):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.topic = topic
+        self.expires = expires
+        self.due = 0.0
+        self.value = None
+        self.error = None
+
+
+class Watches:
+    """Calls methods periodically on the agent, publishes event when result changes
+
+    Replaces clients polling the agent for state changes, calls are made
+    by one background thread without logging
+
+    Args:
+        :bus: EventBus to publish to
+        :call: call(method, args, kwargs) runs method, returns its result
+    """
+
+    def __init__(self, bus: EventBus, call):
+        self._bus = bus
+        self._call = call
+        self._cond = threading.Condition()
+        self._watches = {}  # watch_id : _Watch
+        self._thread = None
+
+    def add(self, method: str, args = (), kwargs = None, interval: float = 1.0, topic: str = None,
+            ttl: float = 3600.0) -> str:
+        """Starts watching method result, returns watch id
+
+        Event data is dict{watch_id,method,value}, or {watch_id,method,error} if method failed.
+        First event is published with the first result, later ones on every change.
+        Topic is 'watch.<method>' by default, watch is removed after ttl seconds
+        """
+        watch_id = uuid4().hex
+        watch = _Watch(method, args, kwargs or {}, interval, topic or f"watch.{method}",
+                       time.monotonic() + ttl)
+        with self._cond:
+            self._watches[watch_id] = watch
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, daemon = True, name = "rpc-watch")
+                self._thread.start()
+            self._cond.notify()
+        return watch_id
+
+    def remove(self, watch_id: str) -> bool:
+        with self._cond:
+            return self._watches.pop(watch_id, None) is not None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                for watch_id in [watch_id for watch_id, watch in self._watches.items()
+                                 if watch.expires <= now]:
+                    del self._watches[watch_id]
+                due = [(watch_id, watch) for watch_id, watch in self._watches.items()
+                       if watch.due <= now]
+                if not due:
+                    next_due = min((watch.due for watch in self._watches.values()), default = None)
+                    self._cond.wait(None if next_due is None else next_due - now)
+                    continue
+            for watch_id, watch in due:
+                self._check(watch_id, watch)
+
+    def _check(self, watch_id: str, watch: _Watch):
+        first = watch.due == 0.0
+        watch.due = time.monotonic() + watch.interval
+        try:
+            value, error = self._call(watch.method, watch.args, watch.kwargs), None
+        except Exception as exc:
+            value, error = None, f"{type(exc).__name__}: {exc}"
+        if first or value != watch.value or error != watch.error:
+            watch.value, watch.error = value, error
+            data = dict({"watch_id": watch_id, "method": watch.method})
+            if error:
+                data["error"] = error
+            else:
+                data["value"] = value
+            self._bus.publish(watch.topic, data)
@@ -1,8 +1,16 @@
 from typing import Dict
+import asyncio
 import threading
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from .client import RPCClient, RPCClient_T
+from .client import RPCClient, RPCMethodCall, RPCMethodCall_T, RPCCallError, TIMEOUT
+from .metrics import merge
+from .async_client import AsyncRPCClient
 from .resolver import RPCResolver
+from .retry import RetryPolicy
+from .breaker import CircuitBreaker, HostUnavailableError
 
 
 class MHosts:
@@ -11,51 +19,240 @@ class MHosts:
     Attrs:
         :all: call same method from all hosts
         :allt: call same method from all hosts async
+        :aall: call same method from all hosts with asyncio, has to be awaited
         :cur: call method from current host(=thread name)
         :curt: call method from current host async(=thread name)
+        :best: call method from the healthiest, least loaded top level host, see best_of()
+        :tree: call same method from all hosts through relays, see below
 
-    Also, each host name passed creates two attributes:
+    completed() returns proxy yielding results of all hosts in completion order,
+    submit() and wait_jobs() run long methods as server-side jobs,
+    events() merges events pushed by all hosts into one iterator, watch() makes hosts
+    publish events on state changes instead of being polled,
+    sync() updates svn/git working copy on all hosts
+
+    Also, each host name passed creates two attributes
+    (unless MHosts has attribute of the same name already):
 
         :<name>: call method from that specific host
         :<name>t: call methods async
 
+    Host clients are created on first use. On start hosts are pinged in parallel
+    according to startup mode:
+
+        :strict: AssertionError if any host has not answered within startup_timeout
+        :mark: such hosts are put to 'unreachable' and their breakers are opened
+        :lazy: hosts are not pinged
+
+    Host parameters may have "unix_socket": path of agent Unix domain socket,
+    used instead of ip:agent_port for agents on the same host (see RPCServer).
+
+    Host parameters may have "relay": name of host which forwards calls to it.
+    Such hosts are not checked on start nor in background and 'best' does not pick them,
+    'tree' reaches them through their relays, so controller talks to top level hosts only
+    (see RPCDispatcher._relay)
+
     Returns:
         result if called from specific host\n
         dict 'host=result' if called from all hosts
 
+    Args:
+        :aio_concurrency: max number of hosts called at once by 'aall'
+        :aio_timeout: per-host timeout for 'aall' calls, in seconds
+        :retry: retry policy of host clients, see retry.RetryPolicy
+        :timeout: max time to wait for a host response, in seconds, so a hung host
+            fails the call instead of blocking it; run longer methods with submit()
+        :health_interval: hosts are pinged in background every that many seconds, 0 - never
+        :breaker_options: passed to breaker.CircuitBreaker of each host,
+            calls to a host with open breaker fail right away with HostUnavailableError
+        :max_workers: size of thread pool running async calls of all hosts
+        :startup: startup mode, see above
+        :startup_timeout: time to wait for hosts to answer on start, in seconds
+        :startup_workers: max number of hosts pinged at once on start
+
     """
-    _hosts = {}
+    STRICT = "strict"
+    MARK = "mark"
+    LAZY = "lazy"
 
     class _MHost:
-        """Host"""
+        """Host, its clients are created on first use"""
 
-        def __init__(self, name: str, ip: str, port: int, log_out_dir: str, f_print_logs: bool):
+        def __init__(self, name: str, ip: str, port: int, log_out_dir: str, f_print_logs: bool,
+                     retry: RetryPolicy = None, timeout: float = TIMEOUT, breaker_options: dict = None,
+                     executor: ThreadPoolExecutor = None, unix_socket: str = None):
             self.name = name
             self.ip = ip
             self.port = port
-            self.rpc = RPCClient(self.ip, self.port,
-                                 remote_host_name = name,
-                                 log_out_dir = log_out_dir,
-                                 f_print_logs = f_print_logs)
-            self.rpct = RPCClient_T(self.ip, self.port,
-                                    remote_host_name = name,
-                                    log_out_dir = log_out_dir,
-                                    f_print_logs = f_print_logs)
-
-    def __init__(self, hosts: Dict[str, dict], log_out_dir: str = None, f_print_logs: bool = False):
-        assert not self._hosts, f"{mhosts} class cannot be instantiated more than once"
+            self.breaker = CircuitBreaker(**(breaker_options or {}))
+            self._client_options = dict({
+                "remote_host_name": name,
+                "log_out_dir": log_out_dir,
+                "f_print_logs": f_print_logs,
+                "retry": retry,
+                "timeout": timeout,
+                "breaker": self.breaker,
+                "unix_socket": unix_socket,
+            })
+            self._executor = executor
+            self._lock = threading.Lock()
+            self._rpc = self._rpct = self._arpc = None
+
+        @property
+        def rpc(self) -> RPCClient:
+            if self._rpc is None:
+                with self._lock:
+                    if self._rpc is None:
+                        self._rpc = RPCClient(self.ip, self.port, **self._client_options)
+            return self._rpc
+
+        @property
+        def rpct(self) -> RPCClient:
+            if self._rpct is None:
+                rpc = self.rpc
+                with self._lock:
+                    if self._rpct is None:
+                        self._rpct = rpc._threaded(self._executor)
+            return self._rpct
+
+        @property
+        def arpc(self) -> AsyncRPCClient:
+            if self._arpc is None:
+                with self._lock:
+                    if self._arpc is None:
+                        self._arpc = AsyncRPCClient(self.ip, self.port, remote_host_name = self.name,
+                                                    timeout = self._client_options["timeout"])
+            return self._arpc
+
+        def check_health(self, timeout: float) -> bool:
+            """Pings host bypassing breaker, records result in the breaker"""
+            started = time.monotonic()
+            try:
+                self.rpc._request("is_alive", ((), {}, "health"), timeout)
+            except Exception:
+                self.breaker.record(False)
+                return False
+            self.breaker.record(True, time.monotonic() - started)
+            return True
+
+    def __init__(self, hosts: Dict[str, dict], log_out_dir: str = None, f_print_logs: bool = False,
+                 aio_concurrency: int = 100, aio_timeout: float = None,
+                 retry: RetryPolicy = None, timeout: float = TIMEOUT,
+                 health_interval: float = 10.0, breaker_options: dict = None, max_workers: int = 32,
+                 startup: str = STRICT, startup_timeout: float = 10.0, startup_workers: int = 64):
         assert hosts
+        assert startup in (MHosts.STRICT, MHosts.MARK, MHosts.LAZY), f"unknown startup mode {startup}"
+        self._hosts = {}
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix = "MHosts call")
         for name, prms in hosts.items():
-            obj = MHosts._MHost(
-                name, prms["ip"], prms["agent_port"], log_out_dir, f_print_logs)
-            assert obj.rpc.is_alive(), f"{obj.name} does not seem to be alive"
-            setattr(self, name, obj.rpc)
-            setattr(self, name + "t", obj.rpct)
-            self._hosts[name] = obj
+            self._hosts[name] = MHosts._MHost(
+                name, prms["ip"], prms["agent_port"], log_out_dir, f_print_logs, retry, timeout,
+                breaker_options, self._executor, prms.get("unix_socket"))
+        self._top = [name for name, prms in hosts.items() if not prms.get("relay")]  # reachable directly
+        self.unreachable = set()
+        if startup != MHosts.LAZY:
+            self.unreachable = self._probe(self._top, startup_timeout, startup_workers)
+            assert startup != MHosts.STRICT or not self.unreachable, \
+                f"{', '.join(sorted(self.unreachable))} do not seem to be alive"
         self.all = MHosts._ProxyAll(self._hosts, False)
         self.allt = MHosts._ProxyAll(self._hosts, True)
+        self.aall = MHosts._ProxyAllAsync(self._hosts, aio_concurrency, aio_timeout)
         self.cur = MHosts._ProxyCurrent(self._hosts, False)
         self.curt = MHosts._ProxyCurrent(self._hosts, True)
+        self.best = self.best_of(self._top)
+        self.tree = MHosts._ProxyTree(self._hosts, MHosts._relay_tree(hosts), self._executor)
+        self._completed = {}  # (quorum, timeout) : _ProxyAll
+        self._stop = threading.Event()
+        if health_interval:
+            threading.Thread(target = self._check_health, args = (health_interval,),
+                             daemon = True, name = "MHosts health").start()
+
+    def __getattr__(self, name: str):
+        """<name> and <name>t host clients, created on first use"""
+        hosts = self.__dict__.get("_hosts", {})
+        if name in hosts:
+            return hosts[name].rpc
+        if name.endswith("t") and name[:-1] in hosts:
+            return hosts[name[:-1]].rpct
+        raise AttributeError(name)
+
+    def _probe(self, names: list, timeout: float, workers: int) -> set:
+        """Pings hosts in parallel, returns names of hosts not answered within timeout
+
+        Breakers of those hosts are opened, so calls to them fail right away
+        until background health check finds them alive
+        """
+        if not names:
+            return set()
+        executor = ThreadPoolExecutor(min(len(names), workers), thread_name_prefix = "MHosts probe")
+        futures = dict({executor.submit(self._hosts[name].check_health, timeout): name
+                        for name in names})
+        done, _ = wait(futures, timeout)
+        executor.shutdown(wait = False, cancel_futures = True)
+        unreachable = set(name for future, name in futures.items()
+                          if future not in done or not future.result())
+        for name in unreachable:
+            self._hosts[name].breaker.trip()
+        return unreachable
+
+    @staticmethod
+    def _relay_tree(hosts: dict) -> dict:
+        """Nested dict 'host_name : {ip,agent_port,hosts}' of top level hosts"""
+        children = dict({name: {} for name in hosts})
+        tree = {}
+        for name, prms in hosts.items():
+            relay = prms.get("relay")
+            assert not relay or relay in hosts, f"{name}: relay {relay} is not in hosts"
+            node = dict({"ip": prms["ip"], "agent_port": prms["agent_port"], "hosts": children[name]})
+            (children[relay] if relay else tree)[name] = node
+
+        def count(nodes):
+            return sum(1 + count(node["hosts"]) for node in nodes.values())
+
+        assert count(tree) == len(hosts), "relays of hosts form a loop"
+        return tree
+
+    def _check_health(self, interval: float):
+        hosts = [self._hosts[name] for name in self._top]  # hosts behind relays may be unreachable
+        with ThreadPoolExecutor(min(len(hosts), 32)) as executor:
+            while not self._stop.wait(interval):
+                try:
+                    list(executor.map(lambda host: host.check_health(interval), hosts))
+                except RuntimeError:  # executor refuses work once interpreter is shutting down
+                    return
+
+    def close(self):
+        """Stops background health checking, cancels queued async calls"""
+        self._stop.set()
+        self._executor.shutdown(wait = False, cancel_futures = True)
+
+    def health(self) -> dict:
+        """dict 'host_name : {state,latency,in_flight,failures}'"""
+        return dict({name: dict({"state": host.breaker.state,
+                                 "latency": host.breaker.latency,
+                                 "in_flight": host.breaker.in_flight,
+                                 "failures": host.breaker.failures})
+                     for name, host in self._hosts.items()})
+
+    def completed(self, quorum: int = None, timeout: float = None):
+        """Returns proxy running method on all hosts in parallel
+
+        Call returns iterator of tuples (host_name, result or exception) in completion order,
+        hosts not finished when iteration stops are in its 'pending' attribute
+
+        Args:
+            :quorum: stop after that many successful results
+            :timeout: stop after that many seconds
+        """
+        proxy = self._completed.get((quorum, timeout))
+        if proxy is None:
+            proxy = self._completed[(quorum, timeout)] = MHosts._ProxyAll(
+                self._hosts, True, (quorum, timeout))
+        return proxy
+
+    def best_of(self, names: list, threaded: bool = False):
+        """Returns proxy calling method from the healthiest, least loaded host of names"""
+        return MHosts._ProxyBest(dict({name: self._hosts[name] for name in names}), threaded)
 
     def __len__(self):
         return len(self._hosts)
@@ -67,30 +264,145 @@ class MHosts:
     def __getitem__(self, name):
         return self._hosts[name]
 
+    def push_file(self, local_path: str, remote_path: str, chunk_size: int = 4 * 1024 * 1024):
+        """Uploads file to all hosts in parallel
+
+        Returns:
+            dict 'host_name : uploaded size'
+        """
+        futures = dict({name: self._executor.submit(host.rpc._upload, local_path, remote_path, chunk_size)
+                        for name, host in self._hosts.items()})
+        return dict({name: f.result() for name, f in futures.items()})
+
+    def submit(self, method: str, *args, **kwargs) -> dict:
+        """Runs method as a job on all hosts, see RPCClient._submit
+
+        Returns:
+            dict 'host_name : RPCJob'
+        """
+        futures = dict({name: self._executor.submit(host.rpc._submit, method, *args, **kwargs)
+                        for name, host in self._hosts.items()})
+        return dict({name: f.result() for name, f in futures.items()})
+
+    def wait_jobs(self, jobs: dict, timeout: float = None) -> dict:
+        """Waits for jobs returned by submit(), one long-poll request per host at a time
+
+        Returns:
+            dict 'host_name : result'\n
+            raises RPCCallError if any job failed, TimeoutError if any has not finished in time
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def result(job):  # time spent queued for executor counts as well
+            return job.result(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+        futures = dict({name: self._executor.submit(result, job) for name, job in jobs.items()})
+        wait(futures.values())
+        return dict({name: f.result() for name, f in futures.items()})
+
+    def events(self, *topics: str, names: list = None):
+        """Subscribes to events of topics on all hosts (or names), see RPCClient._events
+
+        Returns:
+            iterator of tuples (host_name, event) merged in arrival order,
+            or (host_name, exception) once host subscription failed or its stream broke,
+            it has to be closed, see MHosts._EventMux
+        """
+        hosts = dict({name: self._hosts[name] for name in names or self._hosts})
+        futures = dict({name: self._executor.submit(host.rpc._events, *topics)
+                        for name, host in hosts.items()})
+        wait(futures.values())
+        return MHosts._EventMux(futures)
+
+    def watch(self, method: str, args = (), kwargs = None, interval: float = 1.0,
+              topic: str = None, ttl: float = 3600.0) -> dict:
+        """Makes all hosts publish event when method result changes, see RPCClient._watch
+
+        Returns:
+            dict 'host_name : watch_id'
+        """
+        futures = dict({name: self._executor.submit(host.rpc._watch, method, args, kwargs,
+                                                    interval, topic, ttl)
+                        for name, host in self._hosts.items()})
+        return dict({name: f.result() for name, f in futures.items()})
+
+    def sync(self, path: str, vcs: str = "git", revision = None, concurrency: int = 8,
+             force: bool = False, **kwargs) -> dict:
+        """Updates working copy at path on all hosts, at most concurrency hosts at once
+
+        Uses git.pull or svn.update, kwargs are passed to it. Target revision is resolved
+        once on the first host unless given, so hosts at it already skip the update
+        without contacting the repository (see resolver._RevisionIndex)
+
+        Returns:
+            dict 'host_name : dict{path,skipped,before,revision,bytes,duration} or exception'
+        """
+        assert vcs in ("git", "svn"), f"unknown vcs {vcs}"
+        names = list(self._hosts)
+        if revision is None and names:
+            remote_kwargs = dict({key: kwargs[key] for key in ("remote", "branch") if key in kwargs})
+            revision = RPCMethodCall(self._hosts[names[0]].rpc, f"{vcs}.remote_revision")(
+                path, **remote_kwargs)
+        method = "git.pull" if vcs == "git" else "svn.update"
+        rets, running = {}, {}
+        for name in names:
+            if len(running) >= concurrency:
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in done:
+                    rets[running.pop(future)] = future.exception() or future.result()
+            call = RPCMethodCall(self._hosts[name].rpc, method)
+            running[self._executor.submit(call, path, revision = revision, force = force, **kwargs)] = name
+        wait(running)
+        for future, name in running.items():
+            rets[name] = future.exception() or future.result()
+        return dict({name: rets[name] for name in names})
+
+    def metrics(self) -> dict:
+        """Collects metrics of all hosts in parallel
+
+        Returns:
+            dict{hosts,total}, hosts is dict 'host_name : metrics',
+            total is metrics summed over all hosts, see metrics.Metrics.snapshot
+        """
+        futures = dict({name: RPCMethodCall_T(host.rpct, "_metrics")()
+                        for name, host in self._hosts.items()})
+        hosts = dict({name: f.result() for name, f in futures.items()})
+        return dict({"hosts": hosts, "total": merge(hosts.values())})
+
     class _MultiCall:
         """Calls same method on all hosts
 
-        Returns dict host_name : result"""
+        Returns dict host_name : result,
+        or _FanOut if completed (tuple quorum, timeout) is set, threaded calls wait for all
+        hosts to finish before raising first error
+
+        Nested methods are cached like in RPCMethodCall"""
 
-        def __init__(self, method, hosts: dict, threaded: bool):
+        def __init__(self, rpc_methods: dict, threaded: bool, completed: tuple = None):
+            self.rpc_methods = rpc_methods  # either RPCMethodCall or RPCMethodCall_T
             self.threaded = threaded
-            if threaded:
-                self.rpc_methods = dict({
-                    name: getattr(host.rpct, method) for name, host in hosts.items()})
-            else:
-                self.rpc_methods = dict({
-                    name: getattr(host.rpc, method) for name, host in hosts.items()})
+            self.completed = completed
+            self.children = {}
 
         def __getattr__(self, name):
-            for method in self.rpc_methods.values():  # either RPCMethodCall or RPCMethodCall_T
-                getattr(method, name)
-            return self
+            if name.startswith("__"):
+                raise AttributeError(name)
+            try:
+                return self.children[name]
+            except KeyError:
+                child = self.children[name] = MHosts._MultiCall(
+                    dict({host_name: getattr(m, name) for host_name, m in self.rpc_methods.items()}),
+                    self.threaded, self.completed)
+                return child
 
         def __call__(self, *args, **kwargs):
             if self.threaded:
-                return dict(map(lambda t: (t[0], t[1].join()),
-                                [(host_name, m(*args, **kwargs)) for host_name, m
-                                    in self.rpc_methods.items()]))
+                futures = dict([(host_name, m(*args, **kwargs)) for host_name, m
+                                in self.rpc_methods.items()])
+                if self.completed:
+                    return MHosts._FanOut(futures, *self.completed)
+                wait(futures.values())
+                return dict([(host_name, f.result()) for host_name, f in futures.items()])
             return dict([(host_name, m(*args, **kwargs)) for host_name, m
                          in self.rpc_methods.items()])
 
@@ -102,14 +414,269 @@ class MHosts:
             raises RPCCallError on any call fail
         """
 
-        def __init__(self, hosts, threaded: bool):
+        def __init__(self, hosts, threaded: bool, completed: tuple = None):
+            self._hosts = hosts
+            self._threaded = threaded
+            self._completed = completed
+            self._calls = {}
+
+        def __getattribute__(self, name):
+            if name.startswith("_"):
+                return object.__getattribute__(self, name)
+            try:
+                return self._calls[name]
+            except KeyError:
+                client = "rpct" if self._threaded else "rpc"
+                call = self._calls[name] = MHosts._MultiCall(
+                    dict({host_name: getattr(getattr(host, client), name)
+                          for host_name, host in self._hosts.items()}),
+                    self._threaded, self._completed)
+                return call
+
+    class _FanOut:
+        """Collects results of calls running on all hosts in parallel
+
+        Iterating yields tuples (host_name, result or exception) in completion order.
+        Iteration stops when all hosts finished, quorum successful results were yielded,
+        or timeout expired
+
+        Attrs:
+            :pending: names of hosts which have not finished when iteration stopped
+            :succeeded: number of successful results yielded
+            :futures: dict 'host_name : RPCFuture', calls of pending hosts can be cancelled
+        """
+
+        def __init__(self, futures: dict, quorum: int, timeout: float):
+            self.futures = futures
+            self.pending = set(futures)
+            self.succeeded = 0
+            self.quorum = quorum
+            self.deadline = None if timeout is None else time.monotonic() + timeout
+            self._queue = queue.Queue()
+            for host_name, future in futures.items():
+                future.add_done_callback(lambda f, host_name = host_name: self._queue.put((host_name, f)))
+
+        def __iter__(self):
+            while self.pending and (self.quorum is None or self.succeeded < self.quorum):
+                timeout = None
+                if self.deadline is not None:  # results already finished are yielded even then
+                    timeout = max(0.0, self.deadline - time.monotonic())
+                try:
+                    host_name, future = self._queue.get(timeout = timeout)
+                except queue.Empty:
+                    return
+                self.pending.discard(host_name)
+                if future.cancelled():
+                    continue
+                exc = future.exception()
+                self.succeeded += exc is None
+                yield host_name, future.result() if exc is None else exc
+
+    class _EventMux:
+        """Merges event streams of several hosts
+
+        Iterating yields tuples (host_name, event) as events arrive, or (host_name, exception)
+        once host stream failed. Iteration stops when all streams ended, or after close(),
+        which may be called from another thread. Each stream is read by its own thread,
+        since it stays open for the whole subscription
+
+        Attrs:
+            :streams: dict 'host_name : RPCEventStream' of subscribed hosts
+        """
+
+        def __init__(self, futures: dict):
+            self.streams = {}
+            self.closed = False
+            self._queue = queue.Queue()
+            self._running = 0
+            for host_name, future in futures.items():
+                exc = future.exception()
+                if exc is not None:
+                    self._queue.put((host_name, exc))
+                    continue
+                self.streams[host_name] = future.result()
+                self._running += 1
+                threading.Thread(target = self._read, args = (host_name, self.streams[host_name]),
+                                 daemon = True, name = f"rpc-events-{host_name}").start()
+
+        def _read(self, host_name: str, stream):
+            try:
+                for event in stream:
+                    self._queue.put((host_name, event))
+            except Exception as exc:
+                self._queue.put((host_name, exc))
+            self._queue.put((host_name, None))  # stream ended
+
+        def __iter__(self):
+            while self._running or not self._queue.empty():
+                host_name, event = self._queue.get()
+                if event is None:
+                    self._running -= 1
+                elif not self.closed:
+                    yield host_name, event
+
+        def close(self):
+            self.closed = True
+            for stream in self.streams.values():
+                stream.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.close()
+
+    class _AsyncMultiCall:
+        """Calls same method on all hosts with asyncio.gather
+
+        Awaiting the call returns dict host_name : result"""
+
+        def __init__(self, rpc_methods: dict, concurrency: int, timeout: float):
+            self.rpc_methods = rpc_methods
+            self.concurrency = concurrency
+            self.timeout = timeout
+            self.children = {}
+
+        def __getattr__(self, name):
+            if name.startswith("__"):
+                raise AttributeError(name)
+            try:
+                return self.children[name]
+            except KeyError:
+                child = self.children[name] = MHosts._AsyncMultiCall(
+                    dict({host_name: getattr(m, name) for host_name, m in self.rpc_methods.items()}),
+                    self.concurrency, self.timeout)
+                return child
+
+        async def __call__(self, *args, **kwargs):
+            sem = asyncio.Semaphore(self.concurrency)
+
+            async def call(host_name, m):
+                async with sem:
+                    return host_name, await asyncio.wait_for(m(*args, **kwargs), self.timeout)
+
+            return dict(await asyncio.gather(
+                *(call(host_name, m) for host_name, m in self.rpc_methods.items())))
+
+    class _ProxyAllAsync(RPCResolver):
+        """Allows to run same method for all hosts with asyncio
+
+        Returns:
+            coroutine returning dict 'host_name : result'\n
+            raises RPCCallError on any call fail, asyncio.TimeoutError if any host timed out
+        """
+
+        def __init__(self, hosts, concurrency: int, timeout: float):
+            self._hosts = hosts
+            self._concurrency = concurrency
+            self._timeout = timeout
+            self._calls = {}
+
+        def __getattribute__(self, name):
+            if name.startswith("_"):
+                return object.__getattribute__(self, name)
+            try:
+                return self._calls[name]
+            except KeyError:
+                call = self._calls[name] = MHosts._AsyncMultiCall(
+                    dict({host_name: getattr(host.arpc, name) for host_name, host in self._hosts.items()}),
+                    self._concurrency, self._timeout)
+                return call
+
+    class _ProxyBest(RPCResolver):
+        """Run method on the best host of a group
+
+        Hosts with open circuit breaker are skipped, the rest are ranked
+        by CircuitBreaker.score(). Host is picked when method is accessed
+
+        Raises HostUnavailableError if all hosts are unavailable"""
+
+        def __init__(self, hosts: dict, threaded: bool):
             self._hosts = hosts
             self._threaded = threaded
 
         def __getattribute__(self, name):
             if name.startswith("_"):
                 return object.__getattribute__(self, name)
-            return MHosts._MultiCall(name, self._hosts, self._threaded)
+            alive = [host for host in self._hosts.values()
+                     if host.breaker.state != CircuitBreaker.OPEN]
+            if not alive:
+                host = min(self._hosts.values(), key = lambda host: host.breaker.retry_in())
+                raise HostUnavailableError(host.name, host.breaker.retry_in())
+            host = min(alive, key = lambda host: host.breaker.score())
+            if self._threaded:
+                return getattr(host.rpct, name)
+            return getattr(host.rpc, name)
+
+    class _TreeCall:
+        """Calls same method on top level hosts, relays pass it to hosts below them
+
+        Returns dict host_name : result, raises RPCCallError if call failed on any host
+
+        Nested methods are cached like in RPCMethodCall"""
+
+        def __init__(self, hosts: dict, tree: dict, executor: ThreadPoolExecutor, method: str):
+            self.hosts = hosts
+            self.tree = tree
+            self.executor = executor
+            self.method = method
+            self.children = {}
+
+        def __getattr__(self, name):
+            if name.startswith("__"):
+                raise AttributeError(name)
+            try:
+                return self.children[name]
+            except KeyError:
+                child = self.children[name] = MHosts._TreeCall(
+                    self.hosts, self.tree, self.executor, f"{self.method}.{name}")
+                return child
+
+        def __call__(self, *args, **kwargs):
+            calls, futures = {}, {}
+            for name, node in self.tree.items():
+                if node["hosts"]:
+                    call = calls[name] = RPCMethodCall(self.hosts[name].rpc, "_relay")
+                    futures[name] = self.executor.submit(call, self.method, args, kwargs, name,
+                                                         node["hosts"])
+                else:
+                    call = RPCMethodCall(self.hosts[name].rpc, self.method)
+                    futures[name] = self.executor.submit(call, *args, **kwargs)
+            wait(futures.values())
+            ret = {}
+            for name, future in futures.items():
+                if name not in calls:
+                    ret[name] = future.result()
+                    continue
+                for host_name, host_ret in future.result().items():
+                    tb = host_ret.get("traceback")
+                    if tb:
+                        raise RPCCallError(self.method, tb, calls[name].id_, host_name)
+                    ret[host_name] = host_ret.get("returns", None)
+            return ret
+
+    class _ProxyTree(RPCResolver):
+        """Allows to run same method for all hosts through relays
+
+        Returns:
+            dict 'host_name : result'\n
+            raises RPCCallError on any call fail
+        """
+
+        def __init__(self, hosts: dict, tree: dict, executor: ThreadPoolExecutor):
+            self._hosts = hosts
+            self._tree = tree
+            self._executor = executor
+            self._calls = {}
+
+        def __getattribute__(self, name):
+            if name.startswith("_"):
+                return object.__getattribute__(self, name)
+            try:
+                return self._calls[name]
+            except KeyError:
+                call = self._calls[name] = MHosts._TreeCall(self._hosts, self._tree, self._executor, name)
+                return call
 
     class _ProxyCurrent(RPCResolver):
         """Run method on current server
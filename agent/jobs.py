@@ -0,0 +1,145 @@
+import threading
+import time
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+
+MAX_WAIT = 30.0  # long-poll is capped since it holds a server worker
+
+
+class _Job:
+
+    def __init__(self, method: str):
+        self.method = method
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.finished = None
+        self.expires = None  # monotonic time, set once finished
+        self.future = None
+        self.ret = None  # RPCDispatcher._dispatch result dict
+
+    def status(self) -> dict:
+        status = dict({
+            "method": self.method,
+            "state": self.state,
+            "submitted": self.submitted,
+            "finished": self.finished,
+        })
+        if self.state == DONE:
+            status["ret"] = self.ret
+        return status
+
+
+class JobQueue:
+    """Runs method calls in background on a bounded pool
+
+    Jobs are run by run(method, params) which returns RPCDispatcher._dispatch-like
+    result dict. Finished jobs are forgotten ttl seconds after they finished
+
+    Args:
+        :workers: jobs running at once, the rest are queued
+        :max_jobs: unfinished jobs allowed, submit raises RuntimeError above that
+        :ttl: finished job status is kept for that many seconds
+        :on_finish: called as on_finish(job_id, status) once job finished or got cancelled
+    """
+
+    def __init__(self, run, workers: int = 8, max_jobs: int = 10000, ttl: float = 600.0,
+                 on_finish = None):
+        self._run = run
+        self._on_finish = on_finish
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix = "rpc-job")
+        self._cond = threading.Condition(threading.RLock())
+        self._jobs = {}  # job_id : _Job
+        self._unfinished = 0
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.expires and job.expires < now]:
+            del self._jobs[job_id]
+
+    def _get(self, job_id: str) -> _Job:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(f"job {job_id} not found or expired")
+        return job
+
+    def _finish(self, job_id: str, job: _Job, state: str, ret: dict = None):
+        with self._cond:
+            job.state = state
+            job.ret = ret
+            job.finished = time.time()
+            job.expires = time.monotonic() + self.ttl
+            self._unfinished -= 1
+            self._cond.notify_all()
+        if self._on_finish:
+            self._on_finish(job_id, job.status())
+
+    def _worker(self, job_id: str, job: _Job, args, kwargs):
+        with self._cond:
+            if job.state != QUEUED:
+                return  # cancelled
+            job.state = RUNNING
+        self._finish(job_id, job, DONE, self._run(job.method, (args, kwargs, job_id)))
+
+    def submit(self, method: str, args = (), kwargs = None) -> str:
+        """Queues method call, returns job id"""
+        job_id = uuid4().hex
+        with self._cond:
+            self._expire()
+            if self._unfinished >= self.max_jobs:
+                raise RuntimeError(f"job queue is full, {self._unfinished} jobs unfinished")
+            job = self._jobs[job_id] = _Job(method)
+            self._unfinished += 1
+        job.future = self._executor.submit(self._worker, job_id, job, args, kwargs or {})
+        return job_id
+
+    def status(self, job_id: str) -> dict:
+        """dict{method,state,submitted,finished,ret}, ret is set once state is 'done'"""
+        with self._cond:
+            self._expire()
+            return self._get(job_id).status()
+
+    def wait(self, job_ids: list, timeout: float = MAX_WAIT) -> dict:
+        """Waits for all jobs to finish, at most timeout (capped by MAX_WAIT) seconds
+
+        Returns:
+            dict 'job_id : status', see status()
+        """
+        deadline = time.monotonic() + min(timeout, MAX_WAIT)
+        with self._cond:
+            jobs = dict({job_id: self._get(job_id) for job_id in job_ids})
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or all(job.finished for job in jobs.values()):
+                    break
+                self._cond.wait(remaining)
+            return dict({job_id: job.status() for job_id, job in jobs.items()})
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancels queued job, returns False if it is running or finished already"""
+        with self._cond:
+            job = self._get(job_id)
+            if job.state != QUEUED:
+                return False
+            job.future.cancel()  # worker skips the job if it has picked it up already
+            self._finish(job_id, job, CANCELLED)
+        return True
+
+    def stats(self) -> dict:
+        """dict 'state : number of jobs'"""
+        with self._cond:
+            self._expire()
+            ret = dict.fromkeys((QUEUED, RUNNING, DONE, CANCELLED), 0)
+            for job in self._jobs.values():
+                ret[job.state] += 1
+            return ret
+
+    def shutdown(self):
+        self._executor.shutdown(wait = False, cancel_futures = True)
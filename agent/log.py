@@ -0,0 +1,167 @@
+import os
+import json
+import queue
+import reprlib
+import threading
+import zlib
+import atexit
+from datetime import datetime
+
+
+class _Repr(reprlib.Repr):
+    """repr() bounded in size, large values are not copied whole"""
+
+    def __init__(self, max_len: int):
+        super().__init__()
+        self.maxstring = self.maxother = max_len
+        self.maxlist = self.maxtuple = self.maxdict = self.maxset = 20
+
+    def repr_bytes(self, obj, level):
+        if len(obj) <= self.maxstring:
+            return repr(obj)
+        return f"{bytes(obj[:self.maxstring])!r}...<{len(obj)} bytes>"
+
+    repr_bytearray = repr_bytes
+
+    def repr_str(self, obj, level):
+        if len(obj) <= self.maxstring:
+            return repr(obj)
+        return f"{obj[:self.maxstring]!r}...<{len(obj)} chars>"
+
+
+class LogWriter:
+    """Background writer of structured (JSON lines) log records
+
+    log() only puts the record in a queue, records are formatted
+    and written by the writer thread, so callers never wait for disk.
+    When the queue is full records are dropped and counted in 'dropped'
+
+    Args:
+        :path: log file, None to print only
+        :f_print_logs: also print records to stdout
+        :mode: file open mode, 'a' or 'w'
+        :max_bytes: file is rotated once it gets bigger, 0 means never
+        :backups: number of rotated files kept, as path.1 ... path.N
+        :sample_rate: share of calls logged, sampled by call id, errors are always logged.
+            Sampling is stable across processes, so client and server keep the same calls
+        :max_field_len: longer field values are truncated, containers are formatted
+            right in log() with bounded repr, so queued records never keep large call arguments alive
+        :queue_size: max number of records waiting to be written
+    """
+
+    def __init__(self, path: str = None, f_print_logs: bool = False, mode: str = "a",
+                 max_bytes: int = 50 * 1024 * 1024, backups: int = 3, sample_rate: float = 1.0,
+                 max_field_len: int = 1000, queue_size: int = 10000):
+        self.path = path
+        self.f_print_logs = f_print_logs
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rate = sample_rate
+        self.max_field_len = max_field_len
+        self._repr = _Repr(max_field_len)
+        self.dropped = 0
+        self._file = None
+        if path:
+            self._file = open(path, mode, encoding = "utf-8")
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target = self._run, daemon = True,
+                                        name = f"LogWriter<{path}>")
+        self._thread.start()
+
+    def log(self, source: str, id_, method: str, event: str, **fields):
+        """Queues record, values of fields are formatted in writer thread, except containers"""
+        if (self.sample_rate < 1.0 and event != "error"
+                and zlib.crc32(str(id_).encode()) % 10000 >= self.sample_rate * 10000):
+            return
+        for key, value in fields.items():
+            if isinstance(value, (list, tuple, dict, set, bytes, bytearray)):
+                fields[key] = self._repr.repr(value)
+        try:
+            self._queue.put_nowait((datetime.now(), source, id_, method, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes queued records and closes the file"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _format(self, value):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if not isinstance(value, str):
+            value = self._repr.repr(value)
+        if len(value) > self.max_field_len:
+            value = f"{value[:self.max_field_len]}...<{len(value)} chars>"
+        return value
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            try:
+                while True:
+                    records.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            for record in records:
+                if record is None:
+                    if self._file:
+                        self._file.close()
+                    return
+                try:
+                    self._write(record)
+                except Exception as exc:
+                    print(exc)
+            if self._file:
+                self._file.flush()
+                if self.max_bytes and self._file.tell() > self.max_bytes:
+                    self._rotate()
+
+    def _write(self, record):
+        ts, source, id_, method, event, fields = record
+        line = dict({"ts": ts.isoformat(), "source": source, "id": id_,
+                     "method": method, "event": event})
+        for key, value in fields.items():
+            line[key] = self._format(value)
+        line = json.dumps(line, ensure_ascii = False)
+        if self._file:
+            self._file.write(line + "\n")
+        if self.f_print_logs:
+            print(line)
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding = "utf-8")
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path: str = None, f_print_logs: bool = False, **options) -> LogWriter:
+    """Returns LogWriter shared by everyone logging to the same path
+
+    Writer is created by the first call, options of later calls are ignored.
+    Returns None if there is nowhere to log to
+    """
+    if not path and not f_print_logs:
+        return None
+    key = (os.path.abspath(path) if path else None, f_print_logs)
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = _writers[key] = LogWriter(path, f_print_logs, **options)
+        return writer
+
+
+@atexit.register
+def _close_writers():
+    with _writers_lock:
+        for writer in _writers.values():
+            writer.close()
+        _writers.clear()
@@ -0,0 +1,95 @@
+import threading
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class Metrics:
+    """Per-method call/error counters, in-flight gauges and latency histograms
+
+    Args:
+        :buckets: histogram bucket upper bounds in seconds, +Inf is added
+    """
+
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._methods = {}  # method : [calls, errors, in_flight, latency_sum, [bucket counts]]
+
+    def _stats(self, method):
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = self._methods[method] = [0, 0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+        return stats
+
+    def start(self, method: str):
+        with self._lock:
+            self._stats(method)[2] += 1
+
+    def finish(self, method: str, duration: float, error: bool = False):
+        i = 0
+        while i < len(self.buckets) and duration > self.buckets[i]:
+            i += 1
+        with self._lock:
+            stats = self._stats(method)
+            stats[0] += 1
+            stats[1] += error
+            stats[2] -= 1
+            stats[3] += duration
+            stats[4][i] += 1
+
+    def snapshot(self) -> dict:
+        """dict 'method : {calls,errors,in_flight,latency_sum,buckets}'
+
+        buckets is dict 'upper bound : calls', cumulative, as in Prometheus
+        """
+        with self._lock:
+            methods = dict({method: (stats[:4], list(stats[4]))
+                            for method, stats in self._methods.items()})
+        ret = {}
+        for method, ((calls, errors, in_flight, latency_sum), counts) in methods.items():
+            buckets, total = {}, 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                buckets[str(le)] = total
+            ret[method] = dict({
+                "calls": calls,
+                "errors": errors,
+                "in_flight": in_flight,
+                "latency_sum": latency_sum,
+                "buckets": buckets,
+            })
+        return ret
+
+    def prometheus(self) -> str:
+        """Snapshot in Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, key, type_ in (("rpc_calls_total", "calls", "counter"),
+                                 ("rpc_errors_total", "errors", "counter"),
+                                 ("rpc_in_flight", "in_flight", "gauge")):
+            lines.append(f"# TYPE {name} {type_}")
+            for method, stats in snapshot.items():
+                lines.append(f'{name}{{method="{method}"}} {stats[key]}')
+        lines.append("# TYPE rpc_latency_seconds histogram")
+        for method, stats in snapshot.items():
+            for le, count in stats["buckets"].items():
+                lines.append(f'rpc_latency_seconds_bucket{{method="{method}",le="{le}"}} {count}')
+            lines.append(f'rpc_latency_seconds_sum{{method="{method}"}} {stats["latency_sum"]}')
+            lines.append(f'rpc_latency_seconds_count{{method="{method}"}} {stats["calls"]}')
+        return "\n".join(lines) + "\n"
+
+
+def merge(snapshots) -> dict:
+    """Sums several Metrics.snapshot() results"""
+    ret = {}
+    for snapshot in snapshots:
+        for method, stats in snapshot.items():
+            total = ret.get(method)
+            if total is None:
+                ret[method] = dict(stats, buckets = dict(stats["buckets"]))
+                continue
+            for key in ("calls", "errors", "in_flight", "latency_sum"):
+                total[key] += stats[key]
+            for le, count in stats["buckets"].items():
+                total["buckets"][le] = total["buckets"].get(le, 0) + count
+    return ret
@@ -1,8 +1,17 @@
 import inspect
+import os
+import json
+import mmap
+import tempfile
+import zlib
 from typing import Union, Dict
 import subprocess
 from datetime import datetime
 import time
+import threading
+import itertools
+import codecs
+import queue
 
 
 def all_static(cls):
@@ -18,6 +27,264 @@ def all_static(cls):
     return cls
 
 
+def method_index(cls, prefix = "") -> dict:
+    """Flat dict 'dotted.method.name : function' of public methods, including nested"""
+    index = {}
+    for name, m in inspect.getmembers(cls, inspect.isfunction):
+        if not name.startswith("_"):
+            index[prefix + name] = m
+    for name, m in inspect.getmembers(cls, inspect.isclass):
+        if not name.startswith("_"):
+            index.update(method_index(m, f"{prefix}{name}."))
+    return index
+
+
+def cpu_bound(foo):
+    """method decorator, marks method to be run in server process pool if there is one"""
+    foo._rpc_cpu_bound = True
+    return foo
+
+
+def cached(ttl: float = 60.0, max_entries: int = 1024):
+    """method decorator, server serves results of same calls from cache for ttl seconds
+
+    Use for methods without side effects only, see cache.ResultCache
+    """
+
+    def decorator(foo):
+        foo._rpc_cache = dict({"ttl": ttl, "max_entries": max_entries})
+        return foo
+
+    return decorator
+
+
+def invalidates(*methods: str):
+    """method decorator, server clears cached results of methods (dotted names) once it has run"""
+
+    def decorator(foo):
+        foo._rpc_invalidates = methods
+        return foo
+
+    return decorator
+
+
+PART_SUFFIX = ".part"
+
+
+class _ExecStream:
+    """Process started by os.exec_stream
+
+    Reader threads put output chunks in a bounded queue,
+    process gets blocked on write once the queue is full.
+    Stream is killed if nobody reads it for idle_timeout sec,
+    that is checked every REAP_INTERVAL sec by a background thread
+    """
+
+    REAP_INTERVAL = 1.0
+
+    _streams = {}
+    _lock = threading.Lock()
+    _handles = itertools.count(1)
+    _reaper = None
+
+    def __init__(self, args, cwd, env, as_text, buffer_chunks, chunk_size, idle_timeout):
+        self.proc = subprocess.Popen(args, cwd = cwd, env = env, shell = True,
+                                     stdin = subprocess.DEVNULL,
+                                     stdout = subprocess.PIPE,
+                                     stderr = subprocess.PIPE)
+        self.as_text = as_text
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.last_read = time.monotonic()
+        self.queue = queue.Queue(buffer_chunks)
+        self.open_pipes = 2
+        self.closed = False
+        with _ExecStream._lock:
+            self.handle = next(_ExecStream._handles)
+            _ExecStream._streams[self.handle] = self
+            if _ExecStream._reaper is None:
+                _ExecStream._reaper = threading.Thread(target = _ExecStream._reap, daemon = True,
+                                                       name = "rpc-exec-reaper")
+                _ExecStream._reaper.start()
+        for name, pipe in (("stdout", self.proc.stdout), ("stderr", self.proc.stderr)):
+            threading.Thread(target = self._read_pipe, args = (name, pipe), daemon = True).start()
+
+    @classmethod
+    def get(cls, handle):
+        with cls._lock:
+            return cls._streams[handle]
+
+    @classmethod
+    def _reap(cls):
+        """Closes streams not read for idle_timeout, collects exit status of finished processes
+        so they are not left as zombies, exits once there are no streams"""
+        while True:
+            time.sleep(cls.REAP_INTERVAL)
+            with cls._lock:
+                streams = list(cls._streams.values())
+            now = time.monotonic()
+            for stream in streams:
+                stream.proc.poll()
+                if now - stream.last_read > stream.idle_timeout:
+                    stream.close()
+            with cls._lock:
+                if not cls._streams:
+                    cls._reaper = None
+                    return
+
+    def _read_pipe(self, name, pipe):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors = "ignore") if self.as_text else None
+        try:
+            while not self.closed:
+                chunk = pipe.read1(self.chunk_size)
+                if decoder:
+                    chunk = decoder.decode(chunk, final = not chunk)
+                if chunk:
+                    self.queue.put((name, chunk), timeout = self.idle_timeout)
+                if not pipe.peek(1):
+                    break
+        except queue.Full:
+            self.close()
+        finally:
+            pipe.close()
+            if not self.closed:
+                try:
+                    self.queue.put((name, None), timeout = self.idle_timeout)
+                except queue.Full:
+                    self.close()
+
+    def read(self, timeout):
+        """Returns output read so far, waits at most timeout sec for first chunk"""
+        self.last_read = time.monotonic()
+        ret = dict({"stdout": [], "stderr": [], "eof": False, "return_code": None})
+        try:
+            item = self.queue.get(timeout = timeout)
+            while True:
+                name, chunk = item
+                if chunk is None:
+                    self.open_pipes -= 1
+                else:
+                    ret[name].append(chunk)
+                item = self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        empty = "" if self.as_text else b""
+        for name in ("stdout", "stderr"):
+            ret[name] = empty.join(ret[name])
+        if not self.open_pipes:
+            ret["eof"] = True
+            ret["return_code"] = self.proc.wait()
+            self.close()
+        return ret
+
+    def close(self):
+        self.closed = True
+        with _ExecStream._lock:
+            _ExecStream._streams.pop(self.handle, None)
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        try:
+            while True:  # unblock readers
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class _RevisionIndex:
+    """Revisions of working copies updated by svn/git methods, kept in a JSON file
+
+    Lets updates to a known revision skip working copies which are at it already
+    without running svn/git. Changes made to working copies by other means are not seen,
+    such updates have to be forced
+    """
+
+    path = os.environ.get("AGENT_REVISION_INDEX") or os.path.join(tempfile.gettempdir(),
+                                                                  "agent_revisions.json")
+    _lock = threading.Lock()
+    _index = None  # abspath : revision
+
+    @classmethod
+    def _load(cls) -> dict:
+        if cls._index is None:
+            try:
+                with open(cls.path) as f:
+                    cls._index = json.load(f)
+            except (OSError, ValueError):
+                cls._index = {}
+        return cls._index
+
+    @classmethod
+    def get(cls, path: str) -> str:
+        with cls._lock:
+            return cls._load().get(os.path.abspath(path))
+
+    @classmethod
+    def set(cls, path: str, revision: str):
+        with cls._lock:
+            index = cls._load()
+            index[os.path.abspath(path)] = revision
+            tmp = cls.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(index, f, indent = 1)
+            os.replace(tmp, cls.path)
+
+
+def _vcs(args: list, cwd: str) -> str:
+    """Runs svn/git command, returns its stripped output, raises RuntimeError if it failed"""
+    proc = subprocess.run(args, cwd = cwd, capture_output = True, text = True,
+                          encoding = "utf-8", errors = "ignore")
+    if proc.returncode:
+        raise RuntimeError(f"{' '.join(args)} failed with code {proc.returncode}:\n"
+                           f"{proc.stderr or proc.stdout}")
+    return proc.stdout.strip()
+
+
+def _git_store_size(path: str) -> int:
+    """Size of git object store, bytes"""
+    counts = dict(line.split(": ") for line in _vcs(["git", "count-objects", "-v"], path).splitlines())
+    return (int(counts["size"]) + int(counts["size-pack"])) * 1024
+
+
+def _dir_size(path: str) -> int:
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def _git_sync(path: str, remote: str, branch: str, revision: str, force: bool, merge: bool) -> dict:
+    started = time.monotonic()
+    before = _RevisionIndex.get(path) if merge and not force else None
+    ret = dict({"path": path, "skipped": True, "before": before, "revision": revision,
+                "bytes": 0, "duration": 0.0})
+    if revision and before == revision:
+        ret["duration"] = time.monotonic() - started
+        return ret
+    ret["before"] = before = _vcs(["git", "rev-parse", "HEAD"], path)
+    branch = branch or _vcs(["git", "rev-parse", "--abbrev-ref", "HEAD"], path)
+    if not revision:
+        revision = ret["revision"] = RPCResolver.git.remote_revision(path, remote, branch)
+    have = subprocess.run(["git", "cat-file", "-e", f"{revision}^{{commit}}"], cwd = path,
+                          capture_output = True).returncode == 0
+    if not have:
+        size = _git_store_size(path)
+        _vcs(["git", "fetch", "--quiet", remote, branch], path)
+        ret["bytes"] = max(0, _git_store_size(path) - size)
+        ret["skipped"] = False
+    if merge:
+        if before != revision:
+            _vcs(["git", "merge", "--ff-only", "--quiet", revision], path)
+            ret["skipped"] = False
+        _RevisionIndex.set(path, revision)
+    ret["duration"] = time.monotonic() - started
+    return ret
+
+
 @all_static
 class RPCResolver:
     """Static RPC methods resolver
@@ -41,6 +308,13 @@ class RPCResolver:
             time.sleep(1)
             return datetime.now()
 
+        @cpu_bound
+        def foo_cpu_bound(n = 10 ** 6):
+            return str(sum(i * i for i in range(n)))
+
+        def echo(data):
+            return data
+
     def is_alive():
         """indicates if RPC server accessible"""
         return True
@@ -113,6 +387,62 @@ class RPCResolver:
                 "return_code": return_code,
             })
 
+        @cached(ttl = 5.0)
+        def exec_readonly(args: Union[str, list], *, cwd: str = None, env: dict = None,
+                          as_text: bool = True) -> dict:
+            """Execute command without side effects (dir, ver, ...), waits it to finish
+
+            Results of same commands are cached for a few seconds
+
+            Returns:
+                dict{output,return_code}
+            """
+            proc = subprocess.run(args, shell = isinstance(args, str), capture_output = True,
+                                  cwd = cwd, env = env, text = as_text,
+                                  encoding = "utf-8" if as_text else None,
+                                  errors = "ignore" if as_text else None)
+            return dict({
+                "output": proc.stdout,
+                "return_code": proc.returncode,
+            })
+
+        def exec_stream(args: Union[str, list], *, cwd: str = None, env: dict = None,
+                        as_text: bool = True, buffer_chunks: int = 16, chunk_size: int = 64 * 1024,
+                        idle_timeout: float = 300) -> int:
+            """Start process, its output is read by os.read_stream as it arrives
+
+            Args:
+                :args: str as whole command line or list of args
+                :cwd: changes current working dir for running process
+                :env: environmental variables, see subprocess.Popen docs for details
+                :as_text: if True output returned as utf-8 text, otherwise it's a bytes
+                :buffer_chunks: max number of output chunks buffered, process waits when buffer is full
+                :chunk_size: max size of one output chunk
+                :idle_timeout: process is killed if output is not read for that many seconds
+
+            Returns:
+                stream handle
+            """
+            return _ExecStream(args, cwd, env, as_text, buffer_chunks, chunk_size, idle_timeout).handle
+
+        def read_stream(handle: int, timeout: float = 1.0) -> dict:
+            """Read output of process started by os.exec_stream
+
+            Waits at most timeout sec for output, returns everything buffered.
+            Stream is closed once eof is returned
+
+            Returns:
+                dict{stdout,stderr,eof,return_code}
+            """
+            return _ExecStream.get(handle).read(timeout)
+
+        def close_stream(handle: int):
+            """Kill process started by os.exec_stream if still running and drop its output"""
+            try:
+                _ExecStream.get(handle).close()
+            except KeyError:
+                pass
+
         def kill_procs(procs: Union[list, str, int], exclude_pid: int = 0):
             """Kills processes on Windows
 
@@ -153,42 +483,183 @@ class RPCResolver:
             finally:
                 CoUninitialize()
 
+    class files:
+
+        def stat(path: str) -> dict:
+            """File info
+
+            Returns:
+                dict{exists,size,mtime,part_size}, part_size is size of unfinished upload
+            """
+            ret = dict({"exists": os.path.isfile(path), "size": 0, "mtime": None,
+                        "part_size": 0})
+            if ret["exists"]:
+                st = os.stat(path)
+                ret["size"] = st.st_size
+                ret["mtime"] = datetime.fromtimestamp(st.st_mtime)
+            if os.path.isfile(path + PART_SUFFIX):
+                ret["part_size"] = os.path.getsize(path + PART_SUFFIX)
+            return ret
+
+        def read_chunk(path: str, offset: int, size: int) -> dict:
+            """Read file chunk via memory map
+
+            Returns:
+                dict{data,crc32,eof}
+            """
+            with open(path, "rb") as f:
+                file_size = os.fstat(f.fileno()).st_size
+                if offset >= file_size:
+                    data = b""
+                else:
+                    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+                        data = m[offset:offset + size]
+            return dict({
+                "data": data,
+                "crc32": zlib.crc32(data),
+                "eof": offset + len(data) >= file_size,
+            })
+
+        def checksum(path: str, offset: int, size: int) -> int:
+            """crc32 of file range, path may point to unfinished upload (path + PART_SUFFIX)"""
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+                return zlib.crc32(m[offset:offset + size])
+
+        def write_chunk(path: str, offset: int, data: bytes, crc32: int) -> int:
+            """Write chunk of unfinished upload, anything after chunk end is truncated
+
+            Returns:
+                size of unfinished upload
+            """
+            if zlib.crc32(data) != crc32:
+                raise ValueError(f"{path}: chunk at {offset} checksum mismatch")
+            part = path + PART_SUFFIX
+            with open(part, "r+b" if os.path.isfile(part) else "wb") as f:
+                if offset > os.fstat(f.fileno()).st_size:
+                    raise ValueError(f"{path}: chunk at {offset} is past the end of upload")
+                f.seek(offset)
+                f.write(data)
+                f.truncate()
+                return f.tell()
+
+        def commit(path: str, size: int):
+            """Finish upload, moves it in place of path"""
+            part = path + PART_SUFFIX
+            part_size = os.path.getsize(part)
+            if part_size != size:
+                raise ValueError(f"{path}: uploaded {part_size} bytes out of {size}")
+            os.replace(part, path)
+
     class svn:
 
-        def update():
-            pass
+        def revision(path: str) -> int:
+            """Revision of working copy"""
+            return int(_vcs(["svn", "info", "--non-interactive", "--show-item", "revision", path], None))
 
-        def revert():
-            pass
+        def remote_revision(path: str) -> int:
+            """HEAD revision of repository of working copy"""
+            return int(_vcs(["svn", "info", "--non-interactive", "--show-item", "revision",
+                             "-r", "HEAD", path], None))
 
-        def cleanup():
-            pass
+        def update(path: str, revision: int = None, force: bool = False) -> dict:
+            """Update working copy to revision, HEAD by default
+
+            Skipped without running svn if revision index says working copy is at revision
+            already, unless force is set. bytes is growth of pristine store, approximate
+
+            Returns:
+                dict{path,skipped,before,revision,bytes,duration}
+            """
+            started = time.monotonic()
+            before = None if force else _RevisionIndex.get(path)
+            ret = dict({"path": path, "skipped": True, "before": before, "revision": revision,
+                        "bytes": 0, "duration": 0.0})
+            if revision is None or before != revision:
+                ret["before"] = before = RPCResolver.svn.revision(path)
+                if revision is None:
+                    revision = ret["revision"] = RPCResolver.svn.remote_revision(path)
+                if before != revision:
+                    pristine = os.path.join(path, ".svn", "pristine")
+                    size = _dir_size(pristine)
+                    _vcs(["svn", "update", "--non-interactive", "--quiet", "-r", str(revision), path], None)
+                    ret["bytes"] = max(0, _dir_size(pristine) - size)
+                    ret["skipped"] = False
+                _RevisionIndex.set(path, revision)
+            ret["duration"] = time.monotonic() - started
+            return ret
+
+        def revert(path: str) -> list:
+            """Revert local changes of working copy, recursively
+
+            Returns:
+                list of reverted paths
+            """
+            output = _vcs(["svn", "revert", "--non-interactive", "--recursive", path], None)
+            return [line.split("'")[1] for line in output.splitlines() if line.count("'") >= 2]
+
+        def cleanup(path: str):
+            """Release locks of interrupted operations in working copy"""
+            _vcs(["svn", "cleanup", "--non-interactive", path], None)
 
     class git:
 
-        def fetch():
-            pass
+        def revision(path: str) -> str:
+            """Commit checked out in repository"""
+            return _vcs(["git", "rev-parse", "HEAD"], path)
 
-        def pull():
-            pass
+        def remote_revision(path: str, remote: str = "origin", branch: str = None) -> str:
+            """Commit of remote branch, current one by default, nothing is fetched"""
+            branch = branch or _vcs(["git", "rev-parse", "--abbrev-ref", "HEAD"], path)
+            output = _vcs(["git", "ls-remote", remote, f"refs/heads/{branch}"], path)
+            if not output:
+                raise RuntimeError(f"{path}: branch {branch} not found on {remote}")
+            return output.split()[0]
 
-        def push():
-            pass
+        def fetch(path: str, remote: str = "origin", branch: str = None, revision: str = None) -> dict:
+            """Fetch branch, current one by default, skipped if revision
+            (remote branch commit by default) is in the repository already
+
+            Returns:
+                dict{path,skipped,before,revision,bytes,duration}, bytes is growth of object store
+            """
+            return _git_sync(path, remote, branch, revision, False, False)
+
+        def pull(path: str, remote: str = "origin", branch: str = None, revision: str = None,
+                 force: bool = False) -> dict:
+            """Fast-forward branch, current one by default, to revision (remote branch commit by default)
+
+            Skipped without running git if revision index says repository is at revision
+            already, unless force is set; nothing is fetched if revision is there already
+
+            Returns:
+                dict{path,skipped,before,revision,bytes,duration}, bytes is growth of object store
+            """
+            return _git_sync(path, remote, branch, revision, force, True)
+
+        def push(path: str, remote: str = "origin", branch: str = None) -> str:
+            """Push branch, current one by default, returns pushed commit"""
+            branch = branch or _vcs(["git", "rev-parse", "--abbrev-ref", "HEAD"], path)
+            _vcs(["git", "push", "--quiet", remote, branch], path)
+            return _vcs(["git", "rev-parse", branch], path)
 
     class vm:
 
+        @cached(ttl = 10.0)
         def find_machine(vm_name):
             pass
 
+        @cached(ttl = 10.0)
         def find_machine_re(pattern):
             pass
 
+        @invalidates("vm.find_machine", "vm.find_machine_re")
         def make_diff_vm(vm_name):
             pass
 
         def conf_debug_pipe(vm_name):
             pass
 
+        @invalidates("vm.find_machine", "vm.find_machine_re", "vm.get_property")
         def rename(vm_name, new_name):
             pass
 
@@ -201,9 +672,11 @@ class RPCResolver:
         def start(vm_name):
             pass
 
+        @invalidates("vm.get_property")
         def set_property(vm_name, prop, value, type_):
             pass
 
+        @cached(ttl = 10.0)
         def get_property(vm_name, prop):
             pass
 
@@ -219,6 +692,7 @@ class RPCResolver:
         def wait_ready(vm_name):
             pass
 
+        @invalidates("vm.find_machine", "vm.find_machine_re", "vm.get_property")
         def destroy(vm_name):
             pass
 
@@ -0,0 +1,67 @@
+import random
+import http.client
+from xmlrpc.client import ProtocolError
+
+
+class RetryPolicy:
+    """Retry policy of RPCClient calls
+
+    Retries connection errors that guarantee the call was not executed
+    (refused connection, 503 from an overloaded agent). Errors after which the call
+    may have been executed (timeouts, dropped connections) are retried only with retry_unsafe
+
+    Args:
+        :attempts: max number of attempts, 1 means no retries
+        :base_delay: delay before first retry in seconds, doubled for each next one
+        :max_delay: upper bound of a single delay
+        :jitter: randomized share of a delay, 0..1
+        :deadline: time budget of a call in seconds including retries, None means no limit.
+            Remaining time is sent with the call, so the agent can drop it once expired
+        :retry_unsafe: also retry errors after which the call may have been executed
+
+    503 responses are retried no sooner than their Retry-After header asks
+    """
+
+    SAFE = (ConnectionRefusedError,)
+    UNSAFE = (TimeoutError, ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
+              http.client.RemoteDisconnected)
+
+    def __init__(self, attempts: int = 4, base_delay: float = 0.5, max_delay: float = 5.0,
+                 jitter: float = 0.5, deadline: float = None, retry_unsafe: bool = False):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_unsafe = retry_unsafe
+
+    def is_retryable(self, exc: Exception) -> bool:
+        if isinstance(exc, ProtocolError):
+            return exc.errcode == 503
+        if isinstance(exc, self.SAFE):
+            return True
+        return self.retry_unsafe and isinstance(exc, self.UNSAFE)
+
+    def delay(self, attempt: int, exc: Exception) -> float:
+        """Delay before retrying failed attempt (counting from 0), None if it should not be retried"""
+        if attempt + 1 >= self.attempts or not self.is_retryable(exc):
+            return None
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+        return max(delay, self.retry_after(exc))
+
+    @staticmethod
+    def retry_after(exc: Exception) -> float:
+        """Delay asked by Retry-After header of 503 response, 0 if there is none"""
+        if not isinstance(exc, ProtocolError) or not exc.headers:
+            return 0.0
+        for name, value in exc.headers.items():
+            if name.lower() == "retry-after":
+                try:
+                    return float(value)
+                except ValueError:
+                    return 0.0  # http-date form is not used by the agent
+        return 0.0
+
+
+NO_RETRY = RetryPolicy(attempts = 1)
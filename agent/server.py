@@ -1,68 +1,850 @@
+import os
+import selectors
+import socket
+import stat
 import traceback
-from xmlrpc.server import SimpleXMLRPCServer
-from datetime import datetime
+import threading
+import time
+from uuid import uuid4
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from xmlrpc.client import dumps, getparser
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 
-from .resolver import RPCResolver
+from . import codec
+from . import compression
+from .resolver import RPCResolver, method_index
+from .cache import ResultCache
+from .jobs import JobQueue, MAX_WAIT
+from . import events
+from .admission import Admission, Overloaded, PRIORITY, BODY, retry_after_header
+from .client import RPCClient, TIMEOUT
+from .log import get_writer
+from .metrics import Metrics
+
+
+READ_CHUNK = 64 * 1024  # request bodies are read and parsed in chunks of that size
+
+RELAY_MARGIN = 0.1  # seconds _relay keeps before call deadline to send results back
+
+_request_ctx = threading.local()  # 'accepted', 'received' times and 'deadline' of request handled by thread
+
+
+def _closed_by_client(sock) -> bool:
+    """True if client closed connection, which has no unread data"""
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        return not sock.recv(1, socket.MSG_PEEK)
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+    finally:
+        sock.settimeout(timeout)
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of calling method if call deadline expired before it was dispatched"""
 
 
 class RPCServer:
+    """RPC server
+
+    Args:
+        :max_in_flight: number of requests handled at once by worker threads,
+            0 means requests are handled one by one in the listening thread
+        :queue_depth: number of accepted requests allowed to wait for a free worker,
+            requests above that are rejected with 503 right away
+        :process_workers: if set, methods marked with @cpu_bound run in a process pool
+        :keepalive_timeout: idle keep-alive connections are closed after that many seconds,
+            keep-alive is used only when max_in_flight is set, since it holds a worker
+        :log_options: passed to log.LogWriter
+        :compress_threshold: responses larger than that many bytes are compressed
+            if client accepts gzip or deflate, None disables compression
+        :compress_level: zlib compression level, 1 (fastest) - 9 (smallest)
+        :job_options: passed to jobs.JobQueue, which runs methods submitted as jobs
+        :relay_workers: max number of downstream hosts called at once by _relay
+        :relay_timeout: max time _relay waits for a downstream host, call deadline lowers it
+        :method_limits: dict 'method : max calls running at once', calls above that
+            are rejected with 503 and Retry-After, see admission.Admission
+        :priority_methods: cheap methods which are never rejected; when all workers
+            and queue are busy, priority_workers extra threads serve these only
+        :retry_after: seconds rejected clients are asked to wait before retrying
+        :unix_socket: also listen on this Unix domain socket path, for clients on the same host.
+            Large bytes are passed through shared memory there, see codec
+        :event_options: passed to events.EventBus, which pushes events to subscribers
+            on GET /events
+        :held_workers: workers which may be held for long at once by event streams and job
+            long-polls, max_in_flight // 4 (at least 1 if there are 2 workers or more) by default;
+            serial server holds none. Job waits above that are answered right away
+        :max_request_bytes: larger request bodies are rejected with 413 before being read,
+            compressed ones - once they get larger while decompressed; None means no limit
+        :max_body_bytes: request bodies held in memory at once by all requests,
+            requests above that are rejected with 503 and Retry-After; None means no limit.
+            Should be well above max_request_bytes, a body larger than it is never admitted
+    """
 
-    def __init__(self, host = "", port = 55555, log_path = "", f_print_logs = False):
+    def __init__(self, host = "", port = 55555, log_path = "", f_print_logs = False,
+                 max_in_flight = 0, queue_depth = 0, process_workers = 0, keepalive_timeout = 15.0,
+                 log_options = None, compress_threshold = compression.THRESHOLD, compress_level = 6,
+                 job_options = None, relay_workers = 32, method_limits = None,
+                 priority_methods = PRIORITY, priority_workers = 2, retry_after = 1.0,
+                 unix_socket = None, event_options = None, max_request_bytes = 64 * 1024 * 1024,
+                 max_body_bytes = 256 * 1024 * 1024, held_workers = None, relay_timeout = TIMEOUT):
         self.host = host
         self.port = port
         self.log_path = log_path
         self.f_print_logs = f_print_logs
+        self.max_in_flight = max_in_flight
+        self.queue_depth = queue_depth
+        self.process_workers = process_workers
+        self.keepalive_timeout = keepalive_timeout
+        self.log_options = log_options
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.job_options = job_options
+        self.relay_workers = relay_workers
+        self.relay_timeout = relay_timeout
+        self.method_limits = method_limits
+        self.priority_methods = priority_methods
+        self.priority_workers = priority_workers
+        self.retry_after = retry_after
+        self.unix_socket = unix_socket
+        self.event_options = event_options
+        self.max_request_bytes = max_request_bytes
+        self.max_body_bytes = max_body_bytes
+        if held_workers is None:
+            held_workers = max(1, max_in_flight // 4) if max_in_flight > 1 else 0
+        self.held_workers = held_workers if max_in_flight else 0
 
-    def start(self):
-        server = SimpleXMLRPCServer(
-            (self.host, self.port),
+    def _make_server(self, addr, local: bool):
+        kwargs = dict(
+            requestHandler = RPCRequestHandler,
             logRequests = False,
             use_builtin_types = True,
             allow_none = True,
             encoding = "utf-8"
         )
+        if self.max_in_flight:
+            server = (_PooledUnixXMLRPCServer if local else _PooledXMLRPCServer)(
+                addr, self.max_in_flight, self.queue_depth, self.priority_workers, **kwargs)
+            server.keepalive_timeout = self.keepalive_timeout
+        else:
+            server = (_UnixXMLRPCServer if local else SimpleXMLRPCServer)(addr, **kwargs)
+            server.keepalive_timeout = None
+        server.local = local
+        server.compress_threshold = None if local else self.compress_threshold
+        server.compress_level = self.compress_level
+        server.max_request_bytes = self.max_request_bytes
+        return server
+
+    def start(self):
+        server = self._make_server((self.host, self.port), False)
+        local_server = None
+        if self.unix_socket:
+            local_server = self._make_server(self.unix_socket, True)
+        process_pool = None
+        if self.process_workers:
+            process_pool = ProcessPoolExecutor(self.process_workers)
         print(f"Agent listening on port {self.port}...")
-        server.register_instance(RPCDispatcher(self.log_path,
-                                               f_print_logs = self.f_print_logs))
+        dispatcher = RPCDispatcher(self.log_path,
+                                   f_print_logs = self.f_print_logs,
+                                   process_pool = process_pool,
+                                   log_options = self.log_options,
+                                   job_options = self.job_options,
+                                   relay_workers = self.relay_workers,
+                                   relay_timeout = self.relay_timeout,
+                                   event_options = self.event_options,
+                                   admission = Admission(self.method_limits, self.priority_methods,
+                                                         self.retry_after, self.max_body_bytes,
+                                                         self.held_workers))
+        server.register_instance(dispatcher)
+        if local_server:
+            local_server.register_instance(dispatcher)
+            threading.Thread(target = local_server.serve_forever, daemon = True,
+                             name = "rpc-unix-listener").start()
         try:
             server.serve_forever()
         except KeyboardInterrupt:
             print("Stopped!")
             exit(0)
+        finally:
+            server.server_close()
+            if local_server:
+                local_server.shutdown()
+                local_server.server_close()
+            dispatcher.events.close()
+            dispatcher.jobs.shutdown()
+            dispatcher.relay_pool.shutdown(wait = False, cancel_futures = True)
+            if process_pool:
+                process_pool.shutdown(wait = False, cancel_futures = True)
+
+
+class RPCRequestHandler(SimpleXMLRPCRequestHandler):
+    """Request handler
+
+    Keeps HTTP/1.1 connections alive between requests if server has keepalive_timeout,
+    accepts calls in binary format (see codec) besides xml,
+    accepts gzip/deflate requests and compresses large responses (see compression),
+    reads and parses request bodies in chunks, rejects ones above server max_request_bytes with 413,
+    rejects calls not admitted by dispatcher admission control with 503 and Retry-After,
+    serves dispatcher metrics in Prometheus format on GET /metrics,
+    streams dispatcher events on GET /events?topics=<pattern>,... (see events)
+    """
+
+    def setup(self):
+        self.accepted = getattr(_request_ctx, "accepted", None)  # set by pooled server
+        self.priority_only = getattr(_request_ctx, "priority_only", False)
+        self.timeout = self.server.keepalive_timeout
+        if self.timeout and not self.priority_only:  # priority worker serves single request
+            self.protocol_version = "HTTP/1.1"
+        if self.server.local:
+            self.disable_nagle_algorithm = False  # not a TCP socket
+        super().setup()
+
+    def handle(self):
+        """Handles requests of connection while next one is already there,
+        idle keep-alive connection is parked by pooled server, so it does not hold a worker"""
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.request_pending():
+                _request_ctx.park = True
+                return
+            self.handle_one_request()
+
+    def request_pending(self) -> bool:
+        """True if next request has arrived already, closes connection if client closed it"""
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+            if not self.connection.recv(1, socket.MSG_PEEK):
+                self.close_connection = True  # client closed connection
+            return False
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            self.close_connection = True
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def parse_request(self):
+        # first request may have been waiting in the queue since connection was accepted
+        _request_ctx.received = self.accepted or time.monotonic()
+        _request_ctx.deadline = None
+        self.accepted = None
+        return super().parse_request()
+
+    def end_headers(self):
+        self.send_header("X-RPC-Codecs", codec.NAME)
+        if self.server.compress_threshold is not None:
+            self.send_header("X-RPC-Encodings", ",".join(compression.ENCODINGS))
+        super().end_headers()
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path == "/events":
+            self.send_events(parse_qs(query))
+            return
+        if path != "/metrics":
+            self.report_404()
+            return
+        response = self.server.instance.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_POST(self):
+        if not self.is_rpc_path_valid():
+            self.report_404()
+            return
+        binary = self.headers.get("Content-Type") == codec.CONTENT_TYPE
+        length = self.headers.get("Content-Length", "")
+        if not length.isdigit():
+            self.send_empty(411)
+            return
+        length = int(length)
+        max_size = self.server.max_request_bytes
+        if max_size is not None and length > max_size:
+            self.send_empty(413)  # body is left unread, connection gets closed
+            return
+        dispatcher = self.server.instance
+        method, id_ = BODY, 0
+        try:
+            with dispatcher.admission.reserve(length) as reservation:
+                request = self.read_request(length, binary, reservation)
+                if request is None:
+                    return  # response has been sent
+                method, params = request
+                id_ = params[2] if len(params) > 2 else 0
+                with dispatcher.admission.admit(method, self.priority_only):
+                    ret = self.server._dispatch(method, params)
+        except Overloaded as exc:
+            dispatcher.log(id_, method, "rejected", reason = str(exc))
+            self.send_response(503)
+            if method == BODY:
+                self.close_connection = True  # body may be left unread
+                self.send_header("Connection", "close")
+            self.send_header("Retry-After", retry_after_header(exc.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        shm_threshold = None
+        if binary and self.server.local and self.headers.get("X-RPC-Shm"):
+            shm_threshold = int(self.headers["X-RPC-Shm"])
+        segments = []
+        try:
+            response = self.encode_response(ret, binary, shm_threshold, segments)
+        except Exception:
+            codec.release(segments)
+            segments = []
+            response = self.encode_response({"method_called": method,
+                                             "traceback": traceback.format_exc()}, binary)
+        try:
+            self.send_body(response, codec.CONTENT_TYPE if binary else "text/xml")
+        except:
+            codec.release(segments)
+            raise
+        codec.release_later(segments)  # client may not decode response, e.g. if it timed out
+
+    def send_events(self, query: dict):
+        """Streams events of subscribed topics until client disconnects or server stops
+
+        Response is close-delimited, heartbeat frame is sent every events.HEARTBEAT seconds
+        if there are no events. Stream holds a worker, so it needs one of admission max_held
+        (none on serial server); idle stream checks every events.CHECK_INTERVAL seconds
+        whether client has gone, so its worker is freed right away
+        """
+        dispatcher = self.server.instance
+        patterns = [pattern for value in query.get("topics", ["*"])
+                    for pattern in value.split(",") if pattern]
+        with dispatcher.admission.hold() as held:
+            subscription = None
+            if held and not self.priority_only:
+                subscription = dispatcher.events.subscribe(patterns)
+            if subscription is None:
+                self.send_response(503)
+                self.send_header("Retry-After", retry_after_header(dispatcher.admission.retry_after))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.close_connection = True
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", events.CONTENT_TYPE)
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.flush()  # frames go straight to the socket, wfile is buffered
+                self.connection.sendall(events.frame(None))  # subscribed
+                sent = time.monotonic()
+                while not subscription.closed:
+                    event = subscription.get(events.CHECK_INTERVAL)
+                    if event is None:
+                        if _closed_by_client(self.connection):  # it sends nothing while subscribed
+                            break
+                        if time.monotonic() - sent < events.HEARTBEAT:
+                            continue
+                    self.connection.sendall(events.frame(event))
+                    sent = time.monotonic()
+            except OSError:
+                pass  # client is gone
+            finally:
+                dispatcher.events.unsubscribe(subscription)
+
+    @staticmethod
+    def encode_response(ret: dict, binary: bool, shm_threshold: int = None,
+                        segments: list = None) -> bytes:
+        if binary:
+            return codec.dumps(ret, shm_threshold, segments)
+        return dumps((ret,), methodresponse = True, allow_none = True, encoding = "utf-8").encode("utf-8")
+
+    def read_request(self, length: int, binary: bool, reservation):
+        """Reads and parses request body of length bytes chunk by chunk
+
+        Xml is fed to parser as it arrives, so raw body is never held in memory whole.
+        Binary body is read into one buffer, reservation grows by its decompressed size
+        and by size of shared memory segments it refers to
+
+        Returns:
+            tuple (method, params), None if error response has been sent
+        """
+        encoding = self.headers.get("Content-Encoding", "identity").lower()
+        decompressor = None
+        if encoding in compression.ENCODINGS:
+            decompressor = compression.Decompressor(encoding, self.server.max_request_bytes)
+        elif encoding != "identity":
+            self.send_empty(501, f"encoding {encoding!r} not supported")
+            return None
+        try:
+            if binary:
+                data = self.read_body(length, decompressor)
+                if len(data) > length:
+                    reservation.grow(len(data) - length)
+                size, max_size = len(data), self.server.max_request_bytes
+
+                def reserve(segment_size):  # shared memory segments count as body too
+                    nonlocal size
+                    size += segment_size
+                    if max_size is not None and size > max_size:
+                        raise compression.SizeLimitExceeded(
+                            f"shared memory content exceeds {max_size} bytes")
+                    reservation.grow(segment_size)
+
+                method, params = codec.loads(data, shm = self.server.local, reserve = reserve)
+                if not isinstance(method, str) or not isinstance(params, list):
+                    raise ValueError("body is not [method, params]")
+                return method, params
+            parser, unmarshaller = getparser(use_builtin_types = True)
+            for chunk in self.body_chunks(length, decompressor):
+                parser.feed(chunk)
+            parser.close()
+            return unmarshaller.getmethodname(), unmarshaller.close()
+        except Overloaded:
+            raise
+        except compression.SizeLimitExceeded as exc:
+            self.send_empty(413, str(exc))
+        except Exception:
+            self.send_empty(400)
+        return None
+
+    def body_chunks(self, length: int, decompressor = None):
+        """Yields request body as it is read, decompressed if decompressor is given"""
+        remaining = length
+        while remaining:
+            chunk = self.rfile.read(min(remaining, READ_CHUNK))
+            if not chunk:
+                raise ValueError(f"request body ended {remaining} bytes short")
+            remaining -= len(chunk)
+            yield decompressor.feed(chunk) if decompressor else chunk
+        if decompressor:
+            decompressor.close()
+
+    def read_body(self, length: int, decompressor = None) -> bytearray:
+        if decompressor:
+            data = bytearray()
+            for chunk in self.body_chunks(length, decompressor):
+                data += chunk
+            return data
+        data = bytearray(length)
+        view = memoryview(data)
+        pos = 0
+        while pos < length:
+            size = self.rfile.readinto(view[pos:pos + READ_CHUNK])
+            if not size:
+                raise ValueError(f"request body ended {length - pos} bytes short")
+            pos += size
+        return data
+
+    def send_empty(self, code: int, message: str = None):
+        """Sends response without body, connection is closed unless request was answered fully"""
+        self.send_response(code, message)
+        if code >= 400:
+            self.close_connection = True  # request body might have been left unread
+            self.send_header("Connection", "close")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_body(self, response: bytes, content_type: str):
+        """Sends 200 response, compressed if it is large and client accepts that"""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        threshold = self.server.compress_threshold
+        if threshold is not None and len(response) > threshold:
+            encoding = compression.pick(self.accept_encodings())
+            if encoding:
+                compressed = compression.compress(response, encoding, self.server.compress_level)
+                if len(compressed) < len(response):
+                    self.server.instance.compression.add(len(response), len(compressed))
+                    self.send_header("Content-Encoding", encoding)
+                    response = compressed
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_error(self, format, *args):
+        if format.startswith("Request timed out"):
+            return  # idle keep-alive connection expired, nothing to report
+        super().log_error(format, *args)
+
+
+class _PooledXMLRPCServer(SimpleXMLRPCServer):
+    """SimpleXMLRPCServer handling requests on a bounded thread pool
+
+    At most max_in_flight requests are handled at once,
+    at most queue_depth more wait for a free worker.
+    Above that up to priority_workers requests are read by extra threads,
+    which serve priority methods and reject the rest (see admission.Admission).
+    Anything above that is answered with 503 without being read.
+
+    Idle keep-alive connections do not hold a worker: once request is answered,
+    connection is parked in the selector of keep-alive thread and submitted again
+    when next request arrives, it is closed if none arrives within keepalive_timeout
+    """
+
+    def __init__(self, addr, max_in_flight, queue_depth, priority_workers = 0, **kwargs):
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix = "rpc-worker")
+        self._slots = threading.BoundedSemaphore(max_in_flight + queue_depth)
+        self._priority_executor = None
+        if priority_workers:
+            self._priority_executor = ThreadPoolExecutor(priority_workers,
+                                                         thread_name_prefix = "rpc-priority")
+            self._priority_slots = threading.BoundedSemaphore(priority_workers)
+        self._parked = selectors.DefaultSelector()
+        self._parking = []  # [(request, client_address)] to be registered by keep-alive thread
+        self._parking_lock = threading.Lock()
+        self._wakeup, self._wakeup_w = socket.socketpair()
+        self._wakeup_w.setblocking(False)
+        self._parked.register(self._wakeup, selectors.EVENT_READ)
+        self._closing = False
+        self.keepalive_timeout = 15.0
+        threading.Thread(target = self._keepalive, daemon = True, name = "rpc-keepalive").start()
+        super().__init__(addr, **kwargs)
+
+    def process_request(self, request, client_address):
+        if self._slots.acquire(blocking = False):
+            executor, slots, priority_only = self._executor, self._slots, False
+        elif self._priority_executor and self._priority_slots.acquire(blocking = False):
+            executor, slots, priority_only = self._priority_executor, self._priority_slots, True
+        else:
+            self._reject(request)
+            return
+        try:
+            executor.submit(self._process_request_worker, request, client_address,
+                            time.monotonic(), slots, priority_only)
+        except:
+            slots.release()
+            self.shutdown_request(request)
+            raise
+
+    def _process_request_worker(self, request, client_address, accepted, slots, priority_only):
+        _request_ctx.accepted = accepted
+        _request_ctx.priority_only = priority_only
+        _request_ctx.park = False
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            _request_ctx.park = False
+            self.handle_error(request, client_address)
+        finally:
+            _request_ctx.accepted = None
+            _request_ctx.priority_only = False
+            slots.release()  # before parking, next request may arrive right away
+            if _request_ctx.park and not self._closing:
+                self._park(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def _park(self, request, client_address):
+        with self._parking_lock:
+            self._parking.append((request, client_address))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass  # keep-alive thread is woken up already
+
+    def _keepalive(self):
+        idle = {}  # request : parked time
+        while not self._closing:
+            for key, _ in self._parked.select(1.0):
+                if key.fileobj is self._wakeup:
+                    try:
+                        self._wakeup.recv(4096)
+                    except OSError:
+                        pass
+                    with self._parking_lock:
+                        parking, self._parking = self._parking, []
+                    for request, client_address in parking:
+                        self._parked.register(request, selectors.EVENT_READ, client_address)
+                        idle[request] = time.monotonic()
+                else:  # next request arrived, or client closed connection
+                    self._parked.unregister(key.fileobj)
+                    del idle[key.fileobj]
+                    if _closed_by_client(key.fileobj):
+                        self.shutdown_request(key.fileobj)
+                    else:
+                        self.process_request(key.fileobj, key.data)
+            expired = time.monotonic() - self.keepalive_timeout
+            for request in [request for request, parked in idle.items() if parked < expired]:
+                self._parked.unregister(request)
+                del idle[request]
+                self.shutdown_request(request)
+        for request in idle:
+            self.shutdown_request(request)
+
+    def _reject(self, request):
+        retry_after = retry_after_header(self.instance.admission.retry_after).encode()
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\n"
+                            b"Retry-After: " + retry_after + b"\r\n"
+                            b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._closing = True
+        self._wake()
+        self._executor.shutdown(wait = False, cancel_futures = True)
+        if self._priority_executor:
+            self._priority_executor.shutdown(wait = False, cancel_futures = True)
+
+
+class _UnixServerMixin:
+    """Listens on Unix domain socket path instead of TCP address"""
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                os.unlink(self.server_address)  # left by previous run
+        except FileNotFoundError:
+            pass
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+class _UnixXMLRPCServer(_UnixServerMixin, SimpleXMLRPCServer):
+    pass
+
+
+class _PooledUnixXMLRPCServer(_UnixServerMixin, _PooledXMLRPCServer):
+    pass
 
 
 class RPCDispatcher(RPCResolver):
+    """Dispatches calls to RPCResolver methods
 
-    def __init__(self, log_path, f_print_logs = False):
-        self.file = None
-        if log_path:
-            self.file = open(log_path, "a", encoding = "utf-8")
-        self.f_print_logs = f_print_logs
+    Besides resolver methods serves reserved ones:
+        :_batch: several calls in one request
+        :_metrics, _cache_stats, _compression_stats: counters
+        :_job_submit, _job_status, _job_wait, _job_cancel, _job_stats: methods run as jobs,
+            see jobs.JobQueue
+        :_relay: runs method here and forwards it to downstream hosts
+        :_admission_stats: calls rejected by admission control
+        :_event_publish, _event_watch, _event_unwatch, _event_stats: events pushed to
+            subscribers, see events.EventBus and events.Watches
+    """
+
+    def __init__(self, log_path, f_print_logs = False, process_pool = None, log_options = None,
+                 job_options = None, relay_workers = 32, admission: Admission = None,
+                 event_options = None, relay_timeout = TIMEOUT):
+        self.logger = get_writer(log_path, f_print_logs, **(log_options or {}))
+        self.process_pool = process_pool
+        self._methods = method_index(RPCResolver)
+        self.metrics = Metrics()
+        self.compression = compression.CompressionStats()  # of responses
+        self._caches = dict({name: ResultCache(**obj._rpc_cache)  # method : ResultCache
+                             for name, obj in self._methods.items() if hasattr(obj, "_rpc_cache")})
+        self._invalidated = dict({obj: [self._caches[method] for method in obj._rpc_invalidates]
+                                  for obj in self._methods.values() if hasattr(obj, "_rpc_invalidates")})
+        self._methods.update({
+            "_batch": self._batch,
+            "_metrics": self.metrics.snapshot,
+            "_cache_stats": self.cache_stats,
+            "_compression_stats": self.compression.stats,
+        })
+        self.events = events.EventBus(**(event_options or {}))
+        self.watches = events.Watches(self.events, self._watched)
+        self._methods.update({
+            "_event_publish": self.events.publish,
+            "_event_watch": self._event_watch,
+            "_event_unwatch": self.watches.remove,
+            "_event_stats": self.events.stats,
+        })
+        self.jobs = JobQueue(self._run_job, on_finish = self._job_finished, **(job_options or {}))
+        self._methods.update({
+            "_job_submit": self._job_submit,
+            "_job_status": self.jobs.status,
+            "_job_wait": self._job_wait,
+            "_job_cancel": self.jobs.cancel,
+            "_job_stats": self.jobs.stats,
+        })
+        self.relay_pool = ThreadPoolExecutor(relay_workers, thread_name_prefix = "rpc-relay")
+        self.relay_timeout = relay_timeout
+        self._relay_clients = {}  # (ip, port) : RPCClient
+        self._relay_lock = threading.Lock()
+        self._methods["_relay"] = self._relay
+        self.admission = admission or Admission()
+        self._methods["_admission_stats"] = self.admission.stats
         self.log(0, "dispatch", "started")
 
-    def log(self, id_, method, msg):
-        if self.file or self.f_print_logs:
-            msg = f"{datetime.now()}: RPCServer (id={id_}) method=<{method}>: {msg}\n"
-            try:
-                if self.file:
-                    self.file.write(msg)
-                if self.f_print_logs:
-                    print(msg)
-            except Exception as exc:
-                print(exc)
+    def log(self, id_, method, event, **fields):
+        if self.logger:
+            self.logger.log("RPCServer", id_, method, event, **fields)
 
     def _dispatch(self, method, params):
-        args, kwargs, id_ = params
         ret = {"method_called": method}
-        self.log(id_, method, f"calling with args={args},kwargs={kwargs}")
+        obj = self._methods.get(method)
+        metric = method if obj else "<unknown>"  # keeps metrics bounded
+        self.metrics.start(metric)
+        started = time.monotonic()
+        id_ = params[2] if len(params) > 2 else 0
         try:
-            obj = self
-            for part in method.split("."):
-                obj = getattr(obj, part)
+            # (args, kwargs, id_[, meta]) envelope, plain xmlrpc clients do not send it
+            args, kwargs, id_ = params[:3]
+            meta = params[3] if len(params) > 3 else {}
+            self.log(id_, method, "call", args = args, kwargs = kwargs)
+            if obj is None:
+                raise AttributeError(f"method '{method}' not found")
+            if "deadline" in meta:
+                received = getattr(_request_ctx, "received", None) or started
+                _request_ctx.deadline = received + meta["deadline"]
+                if time.monotonic() > _request_ctx.deadline:
+                    raise DeadlineExceeded(f"call expired {time.monotonic() - received:.3f}s "
+                                           f"after being received, deadline was {meta['deadline']:.3f}s")
             ret["method_resolved"] = obj.__qualname__
-            ret["returns"] = obj(*args, **kwargs)
-            self.log(id_, method, f"success")
+            cache = self._caches.get(method)
+            if cache:
+                ret["returns"], hit = cache.call(cache.key(args, kwargs),
+                                                 lambda: self._call(obj, args, kwargs))
+                if hit:
+                    ret["cached"] = True
+            else:
+                ret["returns"] = self._call(obj, args, kwargs)
+            self.log(id_, method, "cached" if "cached" in ret else "success")
         except:
             ret["traceback"] = traceback.format_exc()
-            self.log(id_, method, f"error")
+            self.log(id_, method, "error", traceback = ret["traceback"])
+        self.metrics.finish(metric, time.monotonic() - started, "traceback" in ret)
         return ret
+
+    def _dispatch_admitted(self, method, params):
+        """_dispatch of a call nested in _batch or _relay, admitted the same way as
+        a request is, rejected call returns result dict with admission.Overloaded traceback"""
+        try:
+            with self.admission.admit(method):
+                return self._dispatch(method, params)
+        except Overloaded:
+            ret = {"method_called": method, "traceback": traceback.format_exc()}
+            self.log(params[2], method, "rejected", traceback = ret["traceback"])
+            return ret
+
+    def _run_job(self, method, params):
+        """_dispatch of a job, waits for method slot, as jobs are bounded by job workers already"""
+        with self.admission.admit(method, wait = True):
+            return self._dispatch(method, params)
+
+    def _call(self, obj, args, kwargs):
+        try:
+            if self.process_pool and getattr(obj, "_rpc_cpu_bound", False):
+                return self.process_pool.submit(obj, *args, **kwargs).result()
+            return obj(*args, **kwargs)
+        finally:
+            for cache in self._invalidated.get(obj, ()):  # see resolver.invalidates
+                cache.clear()
+
+    def cache_stats(self) -> dict:
+        """dict 'method : {hits,misses,merged,entries,hit_ratio}' of methods marked @cached"""
+        return dict({method: cache.stats() for method, cache in self._caches.items()})
+
+    def prometheus(self) -> str:
+        """Metrics, cache and compression counters in Prometheus text exposition format"""
+        stats = self.cache_stats()
+        lines = [self.metrics.prometheus().rstrip("\n")]
+        for name, key in (("rpc_cache_hits_total", "hits"),
+                          ("rpc_cache_misses_total", "misses"),
+                          ("rpc_cache_merged_total", "merged")):
+            lines.append(f"# TYPE {name} counter")
+            for method, cache in stats.items():
+                lines.append(f'{name}{{method="{method}"}} {cache[key]}')
+        for key, value in self.compression.stats().items():
+            lines.append(f"# TYPE rpc_compressed_{key}_total counter")
+            lines.append(f"rpc_compressed_{key}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def _job_submit(self, method, args = (), kwargs = None):
+        """Queues method call as a job, returns job id"""
+        if method not in self._methods or method.startswith("_job_"):
+            raise AttributeError(f"method '{method}' cannot be run as a job")
+        return self.jobs.submit(method, args, kwargs)
+
+    def _job_wait(self, job_ids, timeout = MAX_WAIT):
+        """Long-polls jobs, see jobs.JobQueue.wait
+
+        Wait holds a worker, so it needs one of admission max_held, otherwise
+        statuses are returned right away (always on serial server)
+        """
+        with self.admission.hold() as held:
+            return self.jobs.wait(job_ids, timeout if held else 0)
+
+    def _job_finished(self, job_id, status):
+        self.events.publish(f"job.{status['state']}", dict(status, job_id = job_id))
+
+    def _event_watch(self, method, args = (), kwargs = None, interval = 1.0, topic = None, ttl = 3600.0):
+        """Publishes event whenever method result changes, see events.Watches.add"""
+        if method not in self._methods or method.startswith("_event_"):
+            raise AttributeError(f"method '{method}' cannot be watched")
+        return self.watches.add(method, args, kwargs, interval, topic, ttl)
+
+    def _watched(self, method, args, kwargs):
+        return self._call(self._methods[method], args, kwargs)
+
+    def _relay(self, method, args, kwargs, name, hosts):
+        """Runs method here as host <name> and on hosts, in parallel
+
+        hosts is dict 'host_name : {ip,agent_port,hosts}', nested hosts are reached
+        through that host, which relays the call further.
+        Hosts are waited for relay_timeout at most, or until RELAY_MARGIN before call deadline
+
+        Returns:
+            dict 'host_name : result dict' for this host and all hosts below it,
+            result dict is the same as a single call returns
+        """
+        id_ = uuid4().hex
+        deadline = time.monotonic() + self.relay_timeout
+        if getattr(_request_ctx, "deadline", None):
+            deadline = min(deadline, _request_ctx.deadline - RELAY_MARGIN)
+
+        def call(host_name, prms):
+            key = (prms["ip"], prms["agent_port"])
+            with self._relay_lock:
+                client = self._relay_clients.get(key)
+                if client is None:
+                    client = self._relay_clients[key] = RPCClient(*key, remote_host_name = host_name,
+                                                                  timeout = self.relay_timeout)
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("relay deadline expired before host was called")
+                meta = dict({"deadline": remaining})
+                if prms.get("hosts"):
+                    ret = client._request("_relay", ((method, args, kwargs, host_name, prms["hosts"]),
+                                                     {}, id_, meta), remaining)
+                    if "traceback" not in ret:
+                        return ret["returns"]
+                else:
+                    ret = client._request(method, (args, kwargs, id_, meta), remaining)
+            except Exception:
+                ret = {"method_called": method, "traceback": traceback.format_exc()}
+            return {host_name: ret}
+
+        futures = [self.relay_pool.submit(call, host_name, prms) for host_name, prms in hosts.items()]
+        rets = {name: self._dispatch_admitted(method, (args, kwargs, id_))}
+        for future in futures:
+            rets.update(future.result())
+        return rets
+
+    def _batch(self, calls):
+        """Runs list of [method, args, kwargs, id_] calls, each one is admitted separately
+
+        Returns list of per-call result dicts, same as single call returns
+        """
+        return [self._dispatch_admitted(method, (args, kwargs, id_)) for method, args, kwargs, id_ in calls]
@@ -0,0 +1,273 @@
+import http.client
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from xmlrpc.client import Transport, ProtocolError, dumps
+
+from . import codec
+from . import compression
+
+
+class ConnectionPool:
+    """Pool of persistent HTTP/1.1 connections to a single host
+
+    Thread-safe, connections are checked out for the time of one request
+
+    Args:
+        :size: max number of connections checked out at once, checkout blocks above that
+        :idle_timeout: connections idle for longer than that are closed instead of reused,
+            should be lower than server keep-alive timeout
+        :connect_timeout: timeout of establishing new connection
+        :unix_socket: connect to this Unix domain socket path instead of host:port
+    """
+
+    def __init__(self, host: str, port: int, size: int = 4, idle_timeout: float = 10.0,
+                 connect_timeout: float = 5.0, unix_socket: str = None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._idle = []  # [(last_used, connection)], most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _new_connection(self):
+        if self.unix_socket:
+            conn = UnixHTTPConnection(self.unix_socket, timeout = self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout = self.connect_timeout)
+        conn.connect()  # connection errors are raised before anything is sent
+        return conn
+
+    def connect(self):
+        """Returns new connection outside of pool, for long-lived streams"""
+        return self._new_connection()
+
+    def checkout(self):
+        """Returns tuple (connection, reused)"""
+        self._slots.acquire()
+        stale = []
+        try:
+            now = time.monotonic()
+            with self._lock:
+                while self._idle:
+                    last_used, conn = self._idle.pop()
+                    if now - last_used <= self.idle_timeout:
+                        self.hits += 1
+                        return conn, True
+                    stale.append(conn)
+                self.evicted += len(stale)
+                self.misses += 1
+            return self._new_connection(), False
+        except:
+            self._slots.release()
+            raise
+        finally:
+            for conn in stale:
+                conn.close()
+
+    def checkin(self, conn, reuse: bool = True):
+        try:
+            if reuse and conn.sock:
+                with self._lock:
+                    self._idle.append((time.monotonic(), conn))
+            else:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn, _ = self.checkout()
+        try:
+            yield conn
+        except:
+            self.checkin(conn, reuse = False)
+            raise
+        self.checkin(conn)
+
+    def clear(self):
+        """Closes all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, conn in idle:
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict({
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "idle": len(self._idle),
+                "size": self.size,
+            })
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host: str, port: int, size: int = 4, idle_timeout: float = 10.0,
+             connect_timeout: float = 5.0, unix_socket: str = None) -> ConnectionPool:
+    """Returns connection pool shared by all clients of host:port (or unix_socket)
+
+    Pool is created by the first call, settings of later calls are ignored
+    """
+    with _pools_lock:
+        pool = _pools.get((host, port, unix_socket))
+        if pool is None:
+            pool = _pools[(host, port, unix_socket)] = ConnectionPool(
+                host, port, size, idle_timeout, connect_timeout, unix_socket)
+        return pool
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over Unix domain socket"""
+
+    def __init__(self, path: str, timeout = None):
+        super().__init__("localhost", timeout = timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.path)
+        except:
+            self.sock.close()
+            self.sock = None
+            raise
+
+
+class PooledTransport(Transport):
+    """xmlrpc Transport taking connections from ConnectionPool
+
+    Unlike default Transport can be used by several threads at once
+
+    Args:
+        :binary: use binary codec once server advertised it, xml is used until then
+        :compress_threshold: requests larger than that many bytes are compressed
+            once server advertised supported encodings, None disables compression
+            of requests and responses
+        :compress_level: zlib compression level, 1 (fastest) - 9 (smallest)
+        :shm_threshold: over Unix domain socket, bytes larger than that are passed
+            in shared memory both ways (see codec), None disables that
+    """
+
+    def __init__(self, pool: ConnectionPool, use_datetime = False, use_builtin_types = False,
+                 binary = True, compress_threshold = compression.THRESHOLD, compress_level = 6,
+                 shm_threshold = None):
+        super().__init__(use_datetime, use_builtin_types)
+        self._pool = pool
+        self._binary = None if binary else False  # None until negotiated
+        self._encoding = None  # request encoding, set once negotiated
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.compression = compression.CompressionStats()  # of requests
+        self._shm_threshold = shm_threshold if pool.unix_socket else None
+
+    def call(self, method, params, timeout = None, handler = "/"):
+        """Sends method call, returns its result
+
+        timeout limits waiting for each socket operation, None means wait forever
+        """
+        segments = []
+        if self._binary:
+            body = codec.dumps([method, params], self._shm_threshold, segments)
+            content_type = codec.CONTENT_TYPE
+        else:
+            body = dumps(params, method, encoding = "utf-8", allow_none = True).encode("utf-8")
+            content_type = "text/xml"
+        try:
+            ret = self.request(f"{self._pool.host}:{self._pool.port}", handler, body,
+                               content_type = content_type, timeout = timeout)
+        except:
+            codec.release(segments)
+            raise
+        codec.release(segments, unlink = False)
+        return ret
+
+    def request(self, host, handler, request_body, verbose = False, content_type = "text/xml",
+                timeout = None):
+        for i in (0, 1):
+            conn, reused = self._pool.checkout()
+            try:
+                conn.sock.settimeout(timeout)
+                ret = self._single_request(conn, host, handler, request_body, verbose, content_type)
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    ConnectionAbortedError, BrokenPipeError):
+                self._pool.checkin(conn, reuse = False)
+                if i or not reused:
+                    raise
+                # server closed idle connection, others are likely closed as well
+                self._pool.clear()
+                continue
+            except ProtocolError:
+                self._pool.checkin(conn)
+                raise
+            except:
+                self._pool.checkin(conn, reuse = False)
+                raise
+            self._pool.checkin(conn)  # not reused if server asked to close it
+            return ret
+
+    def _single_request(self, conn, host, handler, request_body, verbose, content_type):
+        if verbose:
+            conn.set_debuglevel(1)
+        conn.putrequest("POST", handler, skip_accept_encoding = True)
+        headers = self._headers + [
+            ("Content-Type", content_type),
+            ("User-Agent", self.user_agent),
+        ]
+        if self._shm_threshold is not None:
+            headers.append(("X-RPC-Shm", str(self._shm_threshold)))
+        if self.compress_threshold is not None:
+            headers.append(("Accept-Encoding", ", ".join(compression.ENCODINGS)))
+            if self._encoding and len(request_body) > self.compress_threshold:
+                compressed = compression.compress(request_body, self._encoding, self.compress_level)
+                if len(compressed) < len(request_body):
+                    self.compression.add(len(request_body), len(compressed))
+                    headers.append(("Content-Encoding", self._encoding))
+                    request_body = compressed
+        self.send_headers(conn, headers)
+        try:
+            self.send_content(conn, request_body)
+        except (BrokenPipeError, ConnectionResetError):
+            # server may have rejected request (413, 503) without reading the body
+            try:
+                resp = conn.getresponse()
+            except Exception:
+                resp = None
+            if resp is None or resp.status == 200:
+                raise
+        else:
+            resp = conn.getresponse()
+        if resp.status != 200:
+            resp.read()
+            raise ProtocolError(host + handler, resp.status, resp.reason,
+                                dict(resp.getheaders()))
+        self.verbose = verbose
+        if self._binary is None:
+            self._binary = codec.NAME in resp.getheader("X-RPC-Codecs", "").split(",")
+        if self._encoding is None and self.compress_threshold is not None:
+            self._encoding = compression.pick(resp.getheader("X-RPC-Encodings", "").split(","))
+        data = resp.read()
+        encoding = resp.getheader("Content-Encoding")
+        if encoding:
+            data = compression.decompress(data, encoding)
+        if resp.getheader("Content-Type") == codec.CONTENT_TYPE:
+            return codec.loads(data, shm = self._pool.unix_socket is not None)
+        parser, unmarshaller = self.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()[0]
+
+    def close(self):
+        pass  # connections are owned by the pool
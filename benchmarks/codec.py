@@ -0,0 +1,54 @@
+"""Compares encode/decode cost of xml and binary codec per payload size
+
+Run from repository root:
+    python -m benchmarks.codec
+"""
+import timeit
+from datetime import datetime
+from xmlrpc.client import dumps, loads
+
+from agent import codec
+
+
+def make_payload(size):
+    """os.exec-like result envelope with output of about <size> bytes"""
+    return {
+        "method_called": "os.exec",
+        "method_resolved": "RPCResolver.os.exec",
+        "returns": {
+            "pid": 1234,
+            "output": "x" * size,
+            "return_code": 0,
+            "lines": ["line %d" % i for i in range(size // 1000)],
+            "started": datetime.now(),
+            "raw": b"\x00" * (size // 10),
+            "none": None,
+        },
+    }
+
+
+def xml_dumps(obj):
+    return dumps((obj,), methodresponse = True, encoding = "utf-8", allow_none = True).encode("utf-8")
+
+
+def xml_loads(data):
+    return loads(data, use_datetime = True, use_builtin_types = True)[0][0]
+
+
+def bench(foo, arg):
+    number, total = timeit.Timer(lambda: foo(arg)).autorange()
+    return total / number * 1e6
+
+
+def main():
+    print(f"{'payload':>10} | {'codec':>6} | {'bytes':>10} | {'encode, us':>12} | {'decode, us':>12}")
+    for size in (100, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7):
+        payload = make_payload(size)
+        for name, enc, dec in (("xml", xml_dumps, xml_loads), ("bin", codec.dumps, codec.loads)):
+            data = enc(payload)
+            print(f"{size:>10} | {name:>6} | {len(data):>10} | "
+                  f"{bench(enc, payload):>12.1f} | {bench(dec, data):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Measures per-call overhead of method resolution, without network
+
+Run from repository root:
+    python -m benchmarks.dispatch
+"""
+import timeit
+
+from agent.client import RPCClient
+from agent.server import RPCDispatcher
+
+METHOD = "examples.foo_no_args"
+
+
+def walk_resolve(dispatcher, method):
+    """Resolution as done before method index: getattr for every part of the name"""
+    obj = dispatcher
+    for part in method.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+def bench(foo):
+    number, total = timeit.Timer(foo).autorange()
+    return total / number * 1e9
+
+
+def main():
+    dispatcher = RPCDispatcher("")
+    params = ([], {}, 0)
+    client = RPCClient("127.0.0.1", 55555)
+    print(f"{'case':>40} | {'ns/call':>10}")
+    for name, foo in (
+        ("server: resolve by getattr walk", lambda: walk_resolve(dispatcher, METHOD)),
+        ("server: resolve by index lookup", lambda: dispatcher._methods[METHOD]),
+        ("server: whole _dispatch", lambda: dispatcher._dispatch(METHOD, params)),
+        ("client: new RPCMethodCall per call", lambda: client._resolve_attr("examples").foo_no_args),
+        ("client: cached attribute resolution", lambda: client.examples.foo_no_args),
+    ):
+        print(f"{name:>40} | {bench(foo):>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
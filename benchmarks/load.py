@@ -0,0 +1,240 @@
+"""Load test: starts local agents and drives them with the client stack
+
+Measures throughput, latency percentiles, CPU and RSS of client and servers
+for every combination of mode, concurrency and payload size. Linux only
+(reads /proc), uses loopback only.
+
+Run from repository root:
+    python -m benchmarks.load --servers 3 --concurrency 1 8 32 --payload 100 10000 --out load.json
+
+Modes:
+    client    RPCClient per thread, calls one host
+    client_t  one RPCClient_T, keeps <concurrency> futures in flight
+    all       MHosts.all from <concurrency> threads
+    allt      MHosts.allt from <concurrency> threads
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from agent.client import RPCClient, RPCClient_T
+from agent.hosts import MHosts
+from agent.server import RPCServer
+from agent.transport import get_pool
+
+MODES = ("client", "client_t", "all", "allt")
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def proc_usage(pid: int) -> tuple:
+    """Returns tuple (cpu seconds, rss bytes) of process"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    with open(f"/proc/{pid}/statm") as f:
+        rss_pages = int(f.read().split()[1])
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK, rss_pages * PAGE_SIZE
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def serve(port: int, options: dict):
+    RPCServer(port = port, **options).start()
+
+
+def start_servers(count: int, base_port: int, options: dict) -> dict:
+    """Starts agents in separate processes, returns dict 'host_name : process'"""
+    procs = {}
+    for i in range(count):
+        proc = multiprocessing.Process(target = serve, args = (base_port + i, options), daemon = True)
+        proc.start()
+        procs[f"host{i + 1}"] = proc
+    deadline = time.monotonic() + 10
+    for i in range(count):
+        while True:
+            try:
+                RPCClient("127.0.0.1", base_port + i).is_alive()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+    return procs
+
+
+def run_threads(concurrency: int, duration: float, call) -> tuple:
+    """Runs call() in loop from concurrency threads, returns tuple (latencies, errors)"""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def worker():
+        local, failed = [], 0
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                call()
+            except Exception:
+                failed += 1
+                continue
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target = worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def run_futures(client: RPCClient_T, concurrency: int, duration: float, payload: bytes) -> tuple:
+    """Keeps concurrency calls in flight, returns tuple (latencies, errors)"""
+    latencies, errors = [], 0
+    stop = time.monotonic() + duration
+    in_flight = {}
+    while True:
+        while time.monotonic() < stop and len(in_flight) < concurrency:
+            in_flight[client.examples.echo(payload)] = time.perf_counter()
+        if not in_flight:
+            return latencies, errors
+        done, _ = wait(in_flight, return_when = FIRST_COMPLETED)
+        finished = time.perf_counter()
+        for future in done:
+            started = in_flight.pop(future)
+            if future.exception():
+                errors += 1
+            else:
+                latencies.append(finished - started)
+
+
+def run_case(mode: str, concurrency: int, payload_size: int, duration: float,
+             mhosts: MHosts, base_port: int, procs: dict) -> dict:
+    payload = os.urandom(payload_size)
+    servers_before = [proc_usage(proc.pid) for proc in procs.values()]
+    cpu_before = time.process_time()
+    started = time.monotonic()
+    if mode == "client":
+        clients = threading.local()
+
+        def call():
+            if not hasattr(clients, "client"):
+                clients.client = RPCClient("127.0.0.1", base_port)
+            clients.client.examples.echo(payload)
+
+        latencies, errors = run_threads(concurrency, duration, call)
+    elif mode == "client_t":
+        client = RPCClient_T("127.0.0.1", base_port, max_workers = concurrency)
+        latencies, errors = run_futures(client, concurrency, duration, payload)
+    elif mode == "all":
+        latencies, errors = run_threads(concurrency, duration,
+                                        lambda: mhosts.all.examples.echo(payload))
+    else:
+        latencies, errors = run_threads(concurrency, duration,
+                                        lambda: mhosts.allt.examples.echo(payload))
+    elapsed = time.monotonic() - started
+    client_cpu = time.process_time() - cpu_before
+    servers_after = [proc_usage(proc.pid) for proc in procs.values()]
+    latencies.sort()
+    return dict({
+        "mode": mode,
+        "concurrency": concurrency,
+        "payload": payload_size,
+        "calls": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "latency": dict({
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        }),
+        "client": dict({
+            "cpu": client_cpu,
+            "rss": proc_usage(os.getpid())[1],
+            "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }),
+        "servers": dict({
+            "cpu": sum(after[0] - before[0] for before, after in zip(servers_before, servers_after)),
+            "rss": sum(after[1] for after in servers_after),
+        }),
+    })
+
+
+def print_result(result: dict):
+    latency = result["latency"]
+    ms = lambda value: f"{value * 1000:.2f}" if value is not None else "-"
+    print(f"{result['mode']:>8} | {result['concurrency']:>5} | {result['payload']:>8} | "
+          f"{result['throughput']:>9.1f} | {ms(latency['p50']):>8} | {ms(latency['p95']):>8} | "
+          f"{ms(latency['p99']):>8} | {result['errors']:>6} | {result['client']['cpu']:>7.2f} | "
+          f"{result['servers']['cpu']:>7.2f} | {result['client']['rss'] / 2 ** 20:>7.1f} | "
+          f"{result['servers']['rss'] / 2 ** 20:>7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("--servers", type = int, default = 3)
+    parser.add_argument("--base-port", type = int, default = 56555)
+    parser.add_argument("--modes", nargs = "+", choices = MODES, default = list(MODES))
+    parser.add_argument("--concurrency", type = int, nargs = "+", default = [1, 8, 32])
+    parser.add_argument("--payload", type = int, nargs = "+", default = [100, 10000],
+                        help = "echoed payload sizes, bytes")
+    parser.add_argument("--duration", type = float, default = 5.0, help = "seconds per case")
+    parser.add_argument("--max-in-flight", type = int, default = 16,
+                        help = "server worker threads, 0 - serial server")
+    parser.add_argument("--out", help = "save results to this JSON file")
+    args = parser.parse_args()
+
+    server_options = dict({"max_in_flight": args.max_in_flight,
+                           "queue_depth": 4 * max(args.concurrency)})
+    procs = start_servers(args.servers, args.base_port, server_options)
+    hosts = dict({name: {"ip": "127.0.0.1", "agent_port": args.base_port + i}
+                  for i, name in enumerate(procs)})
+    for host in hosts.values():  # pools are shared, so first client sets their size
+        get_pool(host["ip"], host["agent_port"], max(args.concurrency))
+    mhosts = MHosts(hosts, health_interval = 0, max_workers = max(args.concurrency) * len(hosts))
+    results = []
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    print(f"{'mode':>8} | {'conc':>5} | {'payload':>8} | {'calls/s':>9} | {'p50 ms':>8} | "
+          f"{'p95 ms':>8} | {'p99 ms':>8} | {'errors':>6} | {'cli cpu':>7} | {'srv cpu':>7} | "
+          f"{'cli MiB':>7} | {'srv MiB':>7}")
+    try:
+        for mode in args.modes:
+            for concurrency in args.concurrency:
+                for payload in args.payload:
+                    result = run_case(mode, concurrency, payload, args.duration,
+                                      mhosts, args.base_port, procs)
+                    print_result(result)
+                    results.append(result)
+    finally:
+        mhosts.close()
+        for proc in procs.values():
+            proc.terminate()
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(dict({
+                "config": dict(vars(args), server_options = server_options),
+                "system": dict({"python": platform.python_version(), "cpus": os.cpu_count(),
+                                "platform": platform.platform()}),
+                "started": started,
+                "results": results,
+            }), f, indent = 2)
+        print(f"saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 from agent.hosts import MHosts
 import threading
+from os import path, name as os_name
+from tempfile import gettempdir
 
 """See agent.resolver for available methods"""
 # Simulate having few hosts
@@ -8,6 +10,9 @@ hosts_ = {
     "host2": {"ip": "127.0.0.1", "agent_port": 55556},
     "host3": {"ip": "127.0.0.1", "agent_port": 55557},
 }
+if os_name == "posix":  # agents are local, talk to them through unix sockets, see start_server.py
+    for prms in hosts_.values():
+        prms["unix_socket"] = path.join(gettempdir(), f"agent_{prms['agent_port']}.sock")
 
 
 mhosts = MHosts(hosts_,
@@ -18,9 +23,9 @@ print("host1 foo_no_args\n\t",
       mhosts.host1.examples.foo_no_args())
 
 # run async method on specific host (by adding <t> to host name)
-thread = mhosts.host2t.examples.foo_args_kwargs(1, 2, 3, a = 4, b = 5, c = 6)
+future = mhosts.host2t.examples.foo_args_kwargs(1, 2, 3, a = 4, b = 5, c = 6)
 # wait finish and get result
-print("host2 async foo_args_kwargs\n\t", thread.join())
+print("host2 async foo_args_kwargs\n\t", future.result())
 
 # foo raising exc
 try:
@@ -1,4 +1,5 @@
-from os import path, chdir
+from os import path, chdir, name as os_name
+from tempfile import gettempdir
 import threading
 
 from agent.server import RPCServer
@@ -10,7 +11,9 @@ for port in [55555, 55556, 55557]:
         host = '',
         port = port,
         log_path = path.join(path.dirname(__file__), f"agent_{port}.log"),
-        f_print_logs = False  # if True - server prints logs in stdout
+        f_print_logs = False,  # if True - server prints logs in stdout
+        # local clients may connect through unix socket, see run_example.py
+        unix_socket = path.join(gettempdir(), f"agent_{port}.sock") if os_name == "posix" else None
     )
 
     threading.Thread(target=rpc.start).start()